@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT
+
+# Micro-benchmarks for the uefivars backends. Run with
+#
+#   $ python3 bench_uefivars.py
+#
+# Numbers are only meaningful relative to each other on the same machine.
+
+import io
+import json
+import os
+import struct
+import tempfile
+import timeit
+from pyuefivars import codec
+from pyuefivars.aws import AWSUEFIVarStore
+from pyuefivars.aws_file import AWSVarStoreFile, AWSVarStoreBuffer
+from pyuefivars.codec import U16, EDK2_VAR_HEADER, EDK2_FV_HEADER, EDK2_VARSTORE_HEADER, AWS_VAR_TAIL, \
+    AWS_VAR_AUTH
+from pyuefivars.edk2 import EDK2UEFIVarStore
+from pyuefivars.json import JSONUEFIVarStore
+from pyuefivars.varstore import UEFIVar
+
+
+def load_store(copies: int = 1) -> JSONUEFIVarStore:
+    store = JSONUEFIVarStore(open('testdata/t02.json', 'rb').read())
+    template = list(store.vars)
+    for i in range(1, copies):
+        for var in template:
+            store.vars.append(UEFIVar('%s%d' % (var.name, i), var.data, var.guid, var.attr,
+                                      var.timestamp, var.digest))
+    return store
+
+
+def bench(label: str, fn, records: int, number: int = 10) -> float:
+    best = min(timeit.repeat(fn, number=number, repeat=5)) / number
+    rate = records / best
+    print('  %-40s %12.0f records/sec' % (label, rate))
+    return rate
+
+
+def edk2_varstart(image: bytes) -> int:
+    hlength = EDK2_FV_HEADER.unpack_from(image)[5]
+    return hlength + EDK2_VARSTORE_HEADER.size
+
+
+def edk2_records_file(image: bytes) -> int:
+    # The per-field AWSVarStoreFile reader the EDK2 backend used to use
+    file = AWSVarStoreFile(io.BytesIO(image))
+    file.file.seek(edk2_varstart(image), os.SEEK_SET)
+    count = 0
+    while file.read16() == 0x55aa:
+        file.read8()
+        file.read8()
+        file.read32()
+        file.read64()
+        file.readtimestamp()
+        file.read32()
+        namelen = file.read32()
+        datalen = file.read32()
+        file.readguid()
+        file.read(namelen).decode('utf-16le')
+        file.read(datalen)
+        file.file.seek((file.file.tell() + 0x3) & ~0x3, os.SEEK_SET)
+        count += 1
+    return count
+
+
+def edk2_records_codec(image: bytes) -> int:
+    view = memoryview(image)
+    offset = edk2_varstart(image)
+    count = 0
+    while U16.unpack_from(view, offset)[0] == 0x55aa:
+        namelen, datalen = EDK2_VAR_HEADER.unpack_from(view, offset)[7:9]
+        offset += EDK2_VAR_HEADER.size
+        str(view[offset:offset + namelen], 'utf-16le')
+        view[offset + namelen:offset + namelen + datalen]
+        offset = (offset + namelen + datalen + 0x3) & ~0x3
+        count += 1
+    return count
+
+
+def aws_records_file(raw: bytes) -> int:
+    # The record loop AWSUEFIVarStore used to run: spool the decompressed
+    # payload to a SpooledTemporaryFile and read it field by field
+    raw_file = tempfile.SpooledTemporaryFile()
+    raw_file.write(raw)
+    raw_file.seek(0, os.SEEK_SET)
+    file = AWSVarStoreFile(raw_file)
+    count = file.read64()
+    vars = []
+    for i in range(count):
+        name = file.readstr()
+        data = file.readdata()
+        guid = file.readguid()
+        attr = file.read32()
+        if attr & AWSUEFIVarStore.EFI_VARIABLE_TIME_BASED_AUTHENTICATED_WRITE_ACCESS:
+            timestamp = file.readtimestamp()
+            if timestamp == AWSUEFIVarStore.EMPTY_TIMESTAMP:
+                timestamp = None
+            digest = file.readdata()
+            if digest == AWSUEFIVarStore.EMPTY_DIGEST:
+                digest = None
+            vars.append(UEFIVar(name, data, guid, attr, timestamp, digest))
+        else:
+            vars.append(UEFIVar(name, data, guid, attr))
+    return len(vars)
+
+
+def aws_records_fields(raw: bytes) -> int:
+    # Field by field through AWSVarStoreBuffer, the path records that
+    # straddle a chunk boundary still take
+    raw = AWSVarStoreBuffer(raw)
+    count = raw.read64()
+    vars = []
+    for i in range(count):
+        name = raw.readstr()
+        data = raw.readdata()
+        guid, attr = raw.unpack(AWS_VAR_TAIL)
+        timestamp, digest = None, None
+        if attr & AWSUEFIVarStore.EFI_VARIABLE_TIME_BASED_AUTHENTICATED_WRITE_ACCESS:
+            timestamp, digest_size = raw.unpack(AWS_VAR_AUTH)
+            digest = raw.read(digest_size).tobytes()
+        vars.append(UEFIVar(name, data, guid, attr, timestamp, digest))
+    return len(vars)
+
+
+def aws_records_codec(raw: bytes) -> int:
+    return len(list(AWSUEFIVarStore.unpack_records(AWSVarStoreBuffer(raw))))
+
+
+def bench_codec():
+    print('Binary codec (t02 store x 8):')
+    store = load_store(8)
+    records = len(store.vars)
+
+    store.__class__ = EDK2UEFIVarStore
+    store.length = 4 * EDK2UEFIVarStore.DEFAULT_LENGTH
+    image = bytes(store)
+    before = bench('EDK2 headers, AWSVarStoreFile', lambda: edk2_records_file(image), records)
+    after = bench('EDK2 headers, struct codec', lambda: edk2_records_codec(image), records)
+    print('  %-40s %12.1fx' % ('speedup', after / before))
+
+    store.__class__ = AWSUEFIVarStore
+    raw = bytes(store.pack_records())
+    before = bench('AWS records, SpooledTemporaryFile', lambda: aws_records_file(raw), records)
+    bench('AWS records, field by field', lambda: aws_records_fields(raw), records)
+    after = bench('AWS records, unpack_records', lambda: aws_records_codec(raw), records)
+    print('  %-40s %12.1fx' % ('speedup', after / before))
+
+
+def csum16_struct(var: bytes) -> int:
+    # What EDK2UEFIVarStore.csum16 used to do
+    u16 = struct.unpack("<" + str(int(len(var) / 2)) + "H", var)
+    csum = 0
+    for b in u16:
+        csum = csum + b
+    return (csum & 0xffff)
+
+
+def csum16_memoryview(buf) -> int:
+    # codec.csum16 without the NumPy fast path
+    numpy = codec.numpy
+    codec.numpy = False
+    try:
+        return codec.csum16(buf)
+    finally:
+        codec.numpy = numpy
+
+
+def csum16_numpy(buf) -> int:
+    # The NumPy path of codec.csum16, regardless of CSUM16_NUMPY_MIN
+    numpy = codec.numpy
+    return int(numpy.frombuffer(buf, dtype='<u2').sum(dtype=numpy.uint64)) & 0xffff
+
+
+def bench_csum():
+    header = open('testdata/t02.edk2', 'rb').read(72)
+    image = os.urandom(64 * 1024 * 1024)
+    backends = [('struct loop', csum16_struct), ('memoryview', csum16_memoryview)]
+    if codec.load_numpy():
+        backends.append(('numpy', csum16_numpy))
+        backends.append(('codec.csum16', codec.csum16))
+    else:
+        print('NumPy is not installed, skipping its fast path')
+
+    for label, buf, number in (('72 byte FV header', header, 10000), ('64M flash image', image, 1)):
+        print('FV checksum (%s):' % label)
+        for name, fn in backends:
+            best = min(timeit.repeat(lambda: fn(buf), number=number, repeat=3)) / number
+            print('  %-40s %12.1f MB/sec' % (name, len(buf) / best / 1e6))
+
+
+def json_dumps(store: JSONUEFIVarStore) -> bytes:
+    # What JSONUEFIVarStore.__bytes__ used to do: one json.dumps() of the
+    # whole document
+    return json.dumps({"version": 2, "variables": list(map(store.prepare, store.vars))}, indent=4).encode('utf-8')
+
+
+def bench_json():
+    t02 = load_store()
+    big = load_store()
+    for var in big.vars:
+        if var.name == 'dbx':
+            var.data = var.data * 10
+
+    for label, store in (('t02 store', t02), ('t02 store, 10x dbx', big)):
+        store.__class__ = JSONUEFIVarStore
+        print('JSON encode (%s, %d bytes):' % (label, len(bytes(store))))
+        rates = []
+        for name, fn in (('json.dumps, whole document', json_dumps), ('streaming writer', bytes)):
+            best = min(timeit.repeat(lambda: fn(store), number=20, repeat=5)) / 20
+            rates.append(1 / best)
+            print('  %-40s %12.0f stores/sec' % (name, rates[-1]))
+        print('  %-40s %12.1fx' % ('speedup', rates[1] / rates[0]))
+
+
+if __name__ == '__main__':
+    bench_codec()
+    bench_csum()
+    bench_json()
@@ -4,11 +4,15 @@
 # SPDX-License-Identifier: MIT
 
 import argparse
+import os
 import sys
+import time
+import uuid
 from .varstore import UEFIVar, UEFIVarStore
 from .aws import AWSUEFIVarStore
-from .edk2 import EDK2UEFIVarStore
-from .json import JSONUEFIVarStore
+from .edk2 import EDK2UEFIVarStore, EDK2Watch
+from .json import JSONUEFIVarStore, JSONEvent
+from .jsonl import JSONLUEFIVarStore
 from .efivarfs import EFIVARFSUEFIVarStore
 
 
@@ -25,6 +29,7 @@ def Str2UEFIVarStore(s):
         "aws": AWSUEFIVarStore,
         "edk2": EDK2UEFIVarStore,
         "json": JSONUEFIVarStore,
+        "jsonl": JSONLUEFIVarStore,
         "efivarfs": EFIVARFSUEFIVarStore,
         "none": UEFIVarStore,
     }
@@ -36,6 +41,63 @@ def Str2UEFIVarStore(s):
     raise SystemExit(f'Unknown Input type "{s}", choose from ("{fmt}")')
 
 
+def InputData(input, path):
+    # What the input backend gets handed for the file at path (stdin if None)
+    if input == 'none':
+        return ''
+    if input == 'efivarfs':
+        return path
+    if input == 'edk2' and path:
+        # Gets mapped instead of read
+        return path
+
+    if path:
+        infile = open(path, "rb")
+    else:
+        infile = sys.stdin.buffer
+        print("Reading uefivars from stdin", file=sys.stderr)
+
+    if input in ('json', 'jsonl'):
+        # Gets parsed as it is read
+        return infile
+    return infile.read()
+
+
+def DumpStores(inclass, input, path, output_options, outpath):
+    # Writes every file in the directory at path as one store into a jsonl
+    # stream, with the file name as store id. Files that can not be read get
+    # reported and skipped; they make us fail once all others are written.
+    if any(option.strip().split("=")[0] == 'store' for option in output_options):
+        raise SystemExit('option "store" does not work with directory input, the file names are the store ids')
+
+    outfile = None
+    count = 0
+    failed = 0
+    for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+        if not entry.is_file():
+            continue
+        try:
+            varstore = inclass(InputData(input, entry.path))
+        except (Exception, SystemExit) as e:
+            # Parsers report some bad input, like unknown versions, as
+            # SystemExit
+            print('{}: {}'.format(entry.path, e), file=sys.stderr)
+            failed += 1
+            continue
+        varstore.__class__ = JSONLUEFIVarStore
+        varstore.store_id = entry.name
+        if output_options:
+            varstore.set_output_options(output_options)
+        if outfile is None:
+            outfile = varstore.open_output(outpath) if outpath else sys.stdout.buffer
+        varstore.write(outfile)
+        count += 1
+
+    print("Writen {} stores".format(count), file=sys.stderr)
+    if failed:
+        raise SystemExit('Could not read {} stores'.format(failed))
+
+
 def ReadVar(arg, name, guid):
     EFI_VARIABLE_NON_VOLATILE = 0x00000001
     EFI_VARIABLE_BOOTSERVICE_ACCESS = 0x00000002
@@ -55,18 +117,114 @@ def ReadVar(arg, name, guid):
     return UEFIVar(name, vardata, guid, attr)
 
 
+def VerifyAWS(paths):
+    failed = 0
+    for path in paths:
+        if os.path.isdir(path):
+            failed += VerifyAWS(sorted(entry.path for entry in os.scandir(path) if entry.is_file()))
+            continue
+
+        try:
+            with open(path, "rb") as f:
+                AWSUEFIVarStore.verify(f.read())
+            print('{}: OK'.format(path))
+        except Exception as e:
+            print('{}: FAILED ({})'.format(path, e))
+            failed += 1
+
+    return failed
+
+
+def ListEDK2(paths):
+    for path in paths:
+        for record in EDK2UEFIVarStore.scan(path):
+            if record.state != EDK2UEFIVarStore.STATE_SETTLED:
+                continue
+            guid = uuid.UUID(bytes_le=record.guid)
+            print('{}: {}:{} attr=0x{:x} size={}'.format(path, record.name, guid, record.attr, record.datalen))
+
+
+def WatchEDK2(path, interval):
+    watch = EDK2Watch(path)
+    print('Watching {}'.format(path), file=sys.stderr)
+    while True:
+        time.sleep(interval)
+        try:
+            events = watch.poll()
+        except Exception as e:
+            # Most likely caught the file in the middle of a write, retry
+            print('{}: {}'.format(path, e), file=sys.stderr)
+            continue
+
+        for event in events:
+            print(JSONEvent(*event), flush=True)
+
+
+def GetVar(inclass, indata, arg, store=None):
+    # arg is "NAME:GUID", store the --store id for jsonl input
+    name, _, guid = arg.rpartition(':')
+    try:
+        guid = uuid.UUID(guid).bytes_le
+    except ValueError:
+        raise SystemExit('Invalid GUID "{}" in "{}", expected NAME:GUID'.format(guid, arg))
+
+    if store is not None:
+        var = inclass.find_var(indata, name, guid, store)
+    else:
+        var = inclass.find_var(indata, name, guid)
+    if var is None:
+        raise SystemExit('Variable "{}" not found'.format(arg))
+
+    varstore = UEFIVarStore()
+    varstore.vars.append(var)
+    return varstore
+
+
+def EDK2Stats(path, reclaim=False):
+    varstore = EDK2UEFIVarStore(path)
+    if reclaim:
+        varstore.reclaim(path)
+
+    stats = varstore.stats()
+    print('live: {live} bytes in {vars} records'.format(**stats))
+    print('dead: {dead} bytes'.format(**stats))
+    print('free: {free} of {size} bytes'.format(**stats))
+    print('largest variable: {largest} bytes ({largest_reclaimed} after reclaim)'.format(**stats))
+
+
 def _parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--input", help='Input type ("aws", "json", "edk2", "efivarfs", "none")', required=True)
-    parser.add_argument("-o", "--output", help='Output type ("aws", "json", "edk2[,filesize=512]")', required=True)
+    parser.add_argument("-i", "--input", help='Input type ("aws", "json", "jsonl", "edk2", "efivarfs", "none")')
+    parser.add_argument("-o", "--output",
+                        help='Output type ("aws[,level=9][,budget=BYTES][,threads=N][,incremental]", '
+                             '"json[,base64][,compact]", "jsonl[,store=ID][,append][,base64]", '
+                             '"edk2[,filesize=512|auto][,inplace][,blockdiff]")')
     parser.add_argument("-I", "--inputfile", help='Input file (stdin if not given)')
     parser.add_argument("-O", "--outputfile", help='Output file (stdout if not given)')
     parser.add_argument("-P", "--PK", help='Insert PK from given file (usually PK.esl)')
     parser.add_argument("-K", "--KEK", help='Insert KEK from given file (usually KEK.esl)')
     parser.add_argument("-b", "--db", help='Insert db from given file (usually db.esl)')
     parser.add_argument("-x", "--dbx", help='Insert dbx from given file (usually dbx.esl)')
+    parser.add_argument("--verify", nargs='+', metavar='FILE',
+                        help='Only check header and checksum of the given AWS files or directories')
+    parser.add_argument("--list", nargs='+', metavar='FILE',
+                        help='Only list the variables in the given edk2 files, without reading their data')
+    parser.add_argument("--watch", metavar='FILE',
+                        help='Print JSON events for variables that get added, modified or deleted in an edk2 file')
+    parser.add_argument("--interval", type=float, default=1.0, help='Seconds between checks with --watch')
+    parser.add_argument("--store", metavar='ID', help='Store to read from jsonl input with several stores')
+    parser.add_argument("--get", metavar='NAME:GUID', help='Only read the given variable from the input')
+    parser.add_argument("--edit", metavar='FILE',
+                        help='Update the variables given by -P/-K/-b/-x in place in an existing edk2 file')
+    parser.add_argument("--stats", metavar='FILE',
+                        help='Show how much of the variable store of an edk2 file is used')
+    parser.add_argument("--reclaim", metavar='FILE',
+                        help='Compact the variable store of an edk2 file in place, dropping deleted variables')
 
     args = parser.parse_args()
+    standalone = args.verify or args.list or args.watch or args.edit or args.stats or args.reclaim
+    if not standalone and (args.input is None or args.output is None):
+        parser.error('the following arguments are required: -i/--input, -o/--output')
     return args
 
 
@@ -75,8 +233,34 @@ def main():
     kek_found = -1
     db_found = -1
     dbx_found = -1
+    updated = []
     args = _parser()
 
+    if args.verify:
+        failed = VerifyAWS(args.verify)
+        sys.exit(1 if failed else 0)
+
+    if args.list:
+        ListEDK2(args.list)
+        return
+
+    if args.watch:
+        try:
+            WatchEDK2(args.watch, args.interval)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.stats or args.reclaim:
+        EDK2Stats(args.reclaim or args.stats, reclaim=bool(args.reclaim))
+        return
+
+    if args.edit:
+        # Same as -i edk2 -I FILE, but records get updated in place
+        args.input = 'edk2'
+        args.inputfile = args.edit
+        args.output = 'none'
+
     inclass = Str2UEFIVarStore(args.input)
 
     args.output = [s.strip() for s in args.output.split(",")]
@@ -85,20 +269,23 @@ def main():
 
     outclass = Str2UEFIVarStore(args.output)
 
-    if args.input == 'none':
-        indata = ''
-    elif args.input == 'efivarfs':
-        indata = args.inputfile
-    else:
-        if args.inputfile:
-            infile = open(args.inputfile, "rb")
-        else:
-            infile = sys.stdin.buffer
-            print("Reading uefivars from stdin", file=sys.stderr)
+    if args.store and args.input != 'jsonl':
+        raise SystemExit('--store only works with jsonl input')
 
-        indata = infile.read()
+    if outclass is JSONLUEFIVarStore and args.input != 'efivarfs' and args.inputfile and \
+            os.path.isdir(args.inputfile):
+        # A whole directory of stores
+        DumpStores(inclass, args.input, args.inputfile, output_options, args.outputfile)
+        return
 
-    varstore = inclass(indata)
+    indata = InputData(args.input, args.inputfile)
+
+    if args.get:
+        varstore = GetVar(inclass, indata, args.get, args.store)
+    elif args.input == 'jsonl':
+        varstore = inclass(indata, args.store)
+    else:
+        varstore = inclass(indata)
 
     print("Read {} variables".format(varstore.vars.__len__()), file=sys.stderr)
 
@@ -124,7 +311,8 @@ def main():
             varstore.vars[pk_found] = var
         else:
             varstore.vars.append(var)
-    elif (pk_found == -1):
+        updated.append(var)
+    elif (pk_found == -1 and not args.get):
         print('No PK (PlatformKey) was set; SecureBoot will not be enabled without a PK', file=sys.stderr)
 
     if (args.KEK):
@@ -134,6 +322,7 @@ def main():
             varstore.vars[kek_found] = var
         else:
             varstore.vars.append(var)
+        updated.append(var)
 
     if (args.db):
         var = ReadVar(args.db, 'db', secureDatabaseGUID)
@@ -142,6 +331,7 @@ def main():
             varstore.vars[db_found] = var
         else:
             varstore.vars.append(var)
+        updated.append(var)
 
     if (args.dbx):
         var = ReadVar(args.dbx, 'dbx', secureDatabaseGUID)
@@ -150,17 +340,25 @@ def main():
             varstore.vars[dbx_found] = var
         else:
             varstore.vars.append(var)
+        updated.append(var)
+
+    if args.edit:
+        varstore.update(args.edit, updated)
+        print("Updated {} variables".format(len(updated)), file=sys.stderr)
+        return
 
     # convert the format by changing the output class
     varstore.__class__ = outclass
+    if outclass is JSONLUEFIVarStore and varstore.store_id is None and args.inputfile:
+        varstore.store_id = os.path.basename(args.inputfile)
     if output_options:
         varstore.set_output_options(output_options)
 
     if args.outputfile:
-        outfile = open(args.outputfile, "wb")
+        outfile = varstore.open_output(args.outputfile)
     else:
         outfile = sys.stdout.buffer
-    outfile.write(bytes(varstore))
+    varstore.write(outfile)
 
     print("Writen {} variables".format(varstore.vars.__len__()), file=sys.stderr)
 
@@ -3,79 +3,327 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT
 
-import os
+import sys
 import zlib
 import base64
-import tempfile
+import binascii
 import google_crc32c as crc32c
+from concurrent.futures import ThreadPoolExecutor
 from .varstore import UEFIVar, UEFIVarStore
 from .aws_v0 import UEFIVarStoreV0
-from .aws_file import AWSVarStoreFile
+from .aws_file import AWSVarStoreBuffer
+from .codec import U32, AWS_HEADER, AWS_LENGTH, AWS_VAR_TAIL, AWS_VAR_AUTH
 
 
 class AWSUEFIVarStore(UEFIVarStore):
     EFI_VARIABLE_TIME_BASED_AUTHENTICATED_WRITE_ACCESS = 0x20
     AMZNUEFI = 0x494645554e5a4d41
+    STRATEGY_NAMES = {
+        zlib.Z_DEFAULT_STRATEGY: 'default',
+        zlib.Z_FILTERED: 'filtered',
+        zlib.Z_HUFFMAN_ONLY: 'huffman',
+        zlib.Z_RLE: 'rle',
+    }
+    # (level, strategy) pairs to try for "budget=", cheapest first
+    BUDGET_LADDER = [(1, zlib.Z_HUFFMAN_ONLY), (1, zlib.Z_RLE)] + \
+        [(level, zlib.Z_DEFAULT_STRATEGY) for level in range(1, 10)]
 
-    def __init__(self, b64data: bytes):
+    # Payload size above which "threads=" splits compression into pieces
+    CHUNK_SIZE = 128 * 1024
+
+    # Default limits when decoding untrusted input
+    MAX_SIZE = 16 * 1024 * 1024
+    MAX_VARS = 16 * 1024
+    MAX_VAR_SIZE = 4 * 1024 * 1024
+    INFLATE_CHUNK = 64 * 1024
+    BASE64_BLOCK = 64 * 1024
+
+    # Deflate sync/full flush marker and an empty final block
+    FLUSH_MARKER = b'\x00\x00\xff\xff'
+    FINAL_BLOCK = b'\x03\x00'
+
+    # Output options
+    level = 9
+    budget = None
+    threads = 1
+    incremental = False
+
+    # Compressed input and segments kept for "incremental" output
+    source = None
+    segments = (None, [])
+
+    def __init__(self, b64data: bytes, max_size: int = None, max_vars: int = None, max_var_size: int = None):
         super().__init__()
 
-        # Convert base64 to binary
-        file = tempfile.SpooledTemporaryFile()
-        file.write(base64.b64decode(b64data))
-        file.seek(0, os.SEEK_SET)
+        offsets = []
+        for offset, var in self.read_records(b64data, max_size, max_vars, max_var_size):
+            offsets.append(offset)
+            self.vars.append(var)
+
+        # Remember where the input came from, so "incremental" output can
+        # reuse its compressed records
+        self.source = (b64data, offsets)
+
+    @classmethod
+    def iter_vars(cls, b64data: bytes, max_size: int = None, max_vars: int = None, max_var_size: int = None):
+        # Like the constructor, but hand out variables as they get decoded.
+        # The checksum only gets verified after the last one.
+        for offset, var in cls.read_records(b64data, max_size, max_vars, max_var_size):
+            yield var
+
+    @classmethod
+    def read_records(cls, b64data: bytes, max_size: int = None, max_vars: int = None, max_var_size: int = None):
+        # Decode, checksum, inflate and parse in a single pass
+        payload = cls.payload(b64data)
+        try:
+            yield from cls.parse_records(payload, max_size, max_vars, max_var_size)
+        except Exception:
+            # Damaged input usually trips the parser before we got to see the
+            # checksum. If it is off, report that instead.
+            for zdata in payload:
+                pass
+            raise
+
+        # Run the rest of the input through crc32c
+        for zdata in payload:
+            pass
+
+    @classmethod
+    def find_var(cls, b64data: bytes, name: str, guid: bytes, max_size: int = None,
+                 max_var_size: int = None) -> UEFIVar:
+        # Look up a single variable. Records that don't match get skipped
+        # using their length fields only, without looking at their data.
+        payload = cls.payload(b64data)
+        try:
+            var = cls.scan_records(payload, name, guid, max_size, max_var_size)
+        except Exception:
+            for zdata in payload:
+                pass
+            raise
+
+        # Run the rest of the input through crc32c
+        for zdata in payload:
+            pass
+        return var
+
+    @classmethod
+    def scan_records(cls, zchunks, name: str, guid: bytes, max_size: int = None,
+                     max_var_size: int = None) -> UEFIVar:
+        if max_var_size is None:
+            max_var_size = cls.MAX_VAR_SIZE
+
+        name_bytes = name.encode('utf-8')
+        raw = AWSVarStoreBuffer(b'', more=cls.inflate(zchunks, max_size))
+        nr_entries = raw.read64()
+        for i in range(nr_entries):
+            name_size = raw.read64()
+            if name_size == len(name_bytes):
+                match = raw.read(name_size) == name_bytes
+            else:
+                raw.skip(name_size)
+                match = False
+            if not match:
+                raw.skip(raw.read64())
+                var_guid, attr = raw.unpack(AWS_VAR_TAIL)
+                if attr & cls.EFI_VARIABLE_TIME_BASED_AUTHENTICATED_WRITE_ACCESS:
+                    raw.skip(raw.unpack(AWS_VAR_AUTH)[1])
+                continue
+
+            data = raw.readdata(max_var_size)
+            var_guid, attr = raw.unpack(AWS_VAR_TAIL)
+            timestamp, digest = None, None
+            if attr & cls.EFI_VARIABLE_TIME_BASED_AUTHENTICATED_WRITE_ACCESS:
+                timestamp, digest_size = raw.unpack(AWS_VAR_AUTH)
+                if timestamp == cls.EMPTY_TIMESTAMP:
+                    timestamp = None
+                if digest_size > max_var_size:
+                    raise Exception("Digest of 0x%x bytes exceeds limit of 0x%x" % (digest_size, max_var_size))
+                digest = raw.read(digest_size).tobytes()
+                if digest == cls.EMPTY_DIGEST:
+                    digest = None
+            if var_guid == guid:
+                return UEFIVar(name, data, var_guid, attr, timestamp, digest)
+
+        return None
+
+    @classmethod
+    def verify(cls, b64data: bytes):
+        # Check magic, crc32c and version of a blob without decompressing
+        # it. Raises an exception if any of them is off.
+        for zdata in cls.payload(b64data):
+            pass
 
-        # Then wrap the binary file with our reader and start parsing
-        file = AWSVarStoreFile(file)
-        magic = file.read64()
-        if magic != self.AMZNUEFI:
+    @classmethod
+    def decode_base64(cls, b64data: bytes):
+        # Yield the binary blob in pieces of BASE64_BLOCK characters. Takes
+        # str and any bytes-like object, like base64.b64decode() does.
+        if isinstance(b64data, str):
+            b64data = b64data.encode('ascii')
+        elif not isinstance(b64data, (bytes, bytearray)):
+            b64data = bytes(b64data)
+        for c in b' \t\r\n':
+            if c in b64data:
+                b64data = b64data.translate(None, b' \t\r\n')
+                break
+        view = memoryview(b64data)
+        for i in range(0, len(view), cls.BASE64_BLOCK):
+            yield binascii.a2b_base64(view[i:i + cls.BASE64_BLOCK])
+
+    @classmethod
+    def payload(cls, b64data: bytes):
+        # Yield the zlib payload of a blob while base64 decoding it. All data
+        # after the checksum field goes through crc32c on the way, and the
+        # checksum gets verified once the last piece went out.
+        blocks = cls.decode_base64(b64data)
+        head = b''
+        for block in blocks:
+            head += block
+            if len(head) >= AWS_HEADER.size:
+                break
+        if len(head) < AWS_HEADER.size:
+            raise Exception("Unexpected end of buffer at 0x%x" % len(head))
+
+        magic, crc32, version = AWS_HEADER.unpack_from(head)
+        if magic != cls.AMZNUEFI:
             raise Exception("Invalid magic. Expected AMZNUEFI. Found 0x%x" % magic)
-        crc32 = file.read32()
 
-        # Validate crc32c
-        location = file.file.tell()
-        comp_crc32 = crc32c.value(file.readall())
+        # Validate crc32c (covers the version field and the zlib data)
+        comp_crc32 = crc32c.value(head[AWS_HEADER.size - 4:])
+        if version == 0:
+            yield head[AWS_HEADER.size:]
+        for block in blocks:
+            comp_crc32 = crc32c.extend(comp_crc32, block)
+            if version == 0:
+                yield block
         if (comp_crc32 != crc32):
             raise Exception("Invalid checksum, please check you copied all data")
-        file.file.seek(location, os.SEEK_SET)
 
-        version = file.read32()
         if version != 0:
             raise Exception("Invalid version. Expected 0. Found 0x%x" % version)
 
-        # Grab the zlib data that's embedded and parse it
+    @classmethod
+    def inflate(cls, zchunks, max_size: int = None):
+        # Decompress the zlib payload INFLATE_CHUNK bytes at a time, so we
+        # never hold (or allocate) more than max_size bytes of output
+        if max_size is None:
+            max_size = cls.MAX_SIZE
         dec = zlib.decompressobj(0, zdict=UEFIVarStoreV0.dict)
-        raw_data = dec.decompress(file.readall())
-        raw_file = tempfile.SpooledTemporaryFile()
-        raw_file.write(raw_data)
-        raw_file.seek(0, os.SEEK_SET)
-        raw = AWSVarStoreFile(raw_file)
+        total = 0
+        for zdata in zchunks:
+            while not dec.eof:
+                chunk = dec.decompress(zdata, cls.INFLATE_CHUNK)
+                zdata = dec.unconsumed_tail
+                total += len(chunk)
+                if total > max_size:
+                    raise Exception("Decompressed data exceeds limit of 0x%x bytes" % max_size)
+                if chunk:
+                    yield chunk
+                if not zdata and len(chunk) < cls.INFLATE_CHUNK:
+                    break
+            if dec.eof:
+                break
+
+    @classmethod
+    def unpack_records(cls, raw: AWSVarStoreBuffer, max_vars: int = None, max_var_size: int = None):
+        # Yield (offset, UEFIVar) for every record in raw. Records that sit
+        # completely in the current chunk get unpacked straight from the
+        # view, only the ones that straddle a chunk boundary go through the
+        # field by field readers that pull in more data.
+        if max_vars is None:
+            max_vars = cls.MAX_VARS
+        if max_var_size is None:
+            max_var_size = cls.MAX_VAR_SIZE
+
         nr_entries = raw.read64()
-        for i in range(nr_entries):
-            name = raw.readstr()
-            data = raw.readdata()
-            guid = raw.readguid()
-            attr = raw.read32()
-            if attr & self.EFI_VARIABLE_TIME_BASED_AUTHENTICATED_WRITE_ACCESS:
-                timestamp = raw.readtimestamp()
-                if timestamp == self.EMPTY_TIMESTAMP:
+        if nr_entries > max_vars:
+            raise Exception("Number of variables (%d) exceeds limit of %d" % (nr_entries, max_vars))
+        length = AWS_LENGTH.unpack_from
+        tail = AWS_VAR_TAIL.unpack_from
+        auth = AWS_VAR_AUTH.unpack_from
+        authenticated = cls.EFI_VARIABLE_TIME_BASED_AUTHENTICATED_WRITE_ACCESS
+        i = 0
+        while i < nr_entries:
+            view = raw.view
+            end = len(view)
+            offset = raw.offset
+            while i < nr_entries:
+                name_start = offset + AWS_LENGTH.size
+                if name_start > end:
+                    break
+                name_size = length(view, offset)[0]
+                if name_size > max_var_size:
+                    break
+                data_start = name_start + name_size + AWS_LENGTH.size
+                if data_start > end:
+                    break
+                data_size = length(view, data_start - AWS_LENGTH.size)[0]
+                if data_size > max_var_size:
+                    break
+                data_end = data_start + data_size
+                pos = data_end + AWS_VAR_TAIL.size
+                if pos > end:
+                    break
+                guid, attr = tail(view, data_end)
+                name = view[name_start:data_start - AWS_LENGTH.size]
+                if attr & authenticated:
+                    if pos + AWS_VAR_AUTH.size > end:
+                        break
+                    timestamp, digest_size = auth(view, pos)
+                    if digest_size > max_var_size:
+                        break
+                    pos += AWS_VAR_AUTH.size + digest_size
+                    if pos > end:
+                        break
+                    if timestamp == cls.EMPTY_TIMESTAMP:
+                        timestamp = None
+                    digest = view[pos - digest_size:pos].tobytes()
+                    if digest == cls.EMPTY_DIGEST:
+                        digest = None
+                    var = UEFIVar(str(name, 'utf-8'), view[data_start:data_end], guid, attr, timestamp, digest)
+                else:
+                    var = UEFIVar(str(name, 'utf-8'), view[data_start:data_end], guid, attr)
+                raw.offset = pos
+                i += 1
+                yield raw.base + offset, var
+                offset = pos
+            if i == nr_entries:
+                break
+
+            # Anything that did not fit (or is over a limit, so the readers
+            # raise the usual error) goes through the field readers
+            offset = raw.tell()
+            name = raw.readstr(max_var_size)
+            data = raw.readdata(max_var_size)
+            guid, attr = raw.unpack(AWS_VAR_TAIL)
+            i += 1
+            if attr & authenticated:
+                timestamp, digest_size = raw.unpack(AWS_VAR_AUTH)
+                if timestamp == cls.EMPTY_TIMESTAMP:
                     timestamp = None
-                digest = raw.readdata()
-                if digest == self.EMPTY_DIGEST:
+                if digest_size > max_var_size:
+                    raise Exception("Digest of 0x%x bytes exceeds limit of 0x%x" % (digest_size, max_var_size))
+                digest = raw.read(digest_size).tobytes()
+                if digest == cls.EMPTY_DIGEST:
                     digest = None
-                self.vars.append(UEFIVar(name, data, guid, attr, timestamp, digest))
+                yield offset, UEFIVar(name, data, guid, attr, timestamp, digest)
             else:
-                self.vars.append(UEFIVar(name, data, guid, attr))
+                yield offset, UEFIVar(name, data, guid, attr)
 
-    def __bytes__(self) -> bytes:
-        # Assemble the zlib compressed wrapped file
-        raw = AWSVarStoreFile(tempfile.SpooledTemporaryFile())
-        raw.write64(len(self.vars))
+    @classmethod
+    def parse_records(cls, zchunks, max_size: int = None, max_vars: int = None, max_var_size: int = None):
+        # Yield (offset, UEFIVar) for every record in the zlib payload
+        raw = AWSVarStoreBuffer(b'', more=cls.inflate(zchunks, max_size))
+        yield from cls.unpack_records(raw, max_vars, max_var_size)
+
+    def pack_records(self, offsets: list = None) -> bytearray:
+        # Collect all record fields first so we know how big the raw
+        # payload is, then pack everything into one preallocated buffer
+        records = []
+        size = AWS_LENGTH.size
         for var in self.vars:
-            raw.writestr(var.name)
-            raw.writedata(var.data)
-            raw.writeguid(var.guid)
-            raw.write32(var.attr)
+            name = var.name.encode('utf-8')
+            data = var.data
+            size += 2 * AWS_LENGTH.size + len(name) + len(data) + AWS_VAR_TAIL.size
             if var.attr & self.EFI_VARIABLE_TIME_BASED_AUTHENTICATED_WRITE_ACCESS:
                 timestamp = var.timestamp
                 if timestamp is None:
@@ -85,24 +333,231 @@ class AWSUEFIVarStore(UEFIVarStore):
                 if digest is None:
                     digest = self.EMPTY_DIGEST
 
-                raw.writetimestamp(timestamp)
-                raw.writedata(digest)
-        raw.file.seek(0, os.SEEK_SET)
+                size += AWS_VAR_AUTH.size + len(digest)
+            else:
+                timestamp, digest = None, None
+            records.append((name, data, var.guid, var.attr, timestamp, digest))
+
+        raw = bytearray(size)
+        AWS_LENGTH.pack_into(raw, 0, len(records))
+        offset = AWS_LENGTH.size
+        for name, data, guid, attr, timestamp, digest in records:
+            if offsets is not None:
+                offsets.append(offset)
+            for field in (name, data):
+                AWS_LENGTH.pack_into(raw, offset, len(field))
+                offset += AWS_LENGTH.size
+                raw[offset:offset + len(field)] = field
+                offset += len(field)
+            AWS_VAR_TAIL.pack_into(raw, offset, guid, attr)
+            offset += AWS_VAR_TAIL.size
+            if digest is not None:
+                AWS_VAR_AUTH.pack_into(raw, offset, timestamp, len(digest))
+                offset += AWS_VAR_AUTH.size
+                raw[offset:offset + len(digest)] = digest
+                offset += len(digest)
+
+        return raw
+
+    def compress(self, raw: bytes, level: int, strategy: int = zlib.Z_DEFAULT_STRATEGY) -> bytes:
+        if self.threads != 1 and len(raw) > self.CHUNK_SIZE:
+            return self.compress_parallel(raw, level, strategy)
+
+        enc = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, strategy,
+                               zdict=UEFIVarStoreV0.dict)
+        return enc.compress(raw) + enc.flush()
+
+    def history(self, raw, start: int) -> bytes:
+        # The 32K of data a deflate decoder has seen before reaching offset
+        # "start" of the payload: the V0 dictionary followed by the payload
+        window = 1 << zlib.MAX_WBITS
+        history = bytes(raw[max(0, start - window):start])
+        if len(history) < window:
+            history = (UEFIVarStoreV0.dict + history)[-window:]
+        return history
+
+    def deflate_piece(self, raw, start: int, end: int, level: int, strategy: int = zlib.Z_DEFAULT_STRATEGY,
+                      history: bytes = None, finish: bool = None) -> bytes:
+        # Raw deflate raw[start:end] so that it can be spliced into a stream
+        # right after raw[:start]. Pieces in the middle end on a sync flush,
+        # which leaves them byte aligned; by default the last one finishes
+        # the stream.
+        if history is None:
+            history = self.history(raw, start)
+        if finish is None:
+            finish = end == len(raw)
+        enc = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, strategy,
+                               zdict=history)
+        zdata = enc.compress(memoryview(raw)[start:end])
+        return zdata + enc.flush(zlib.Z_FINISH if finish else zlib.Z_SYNC_FLUSH)
+
+    def compress_parallel(self, raw: bytes, level: int, strategy: int = zlib.Z_DEFAULT_STRATEGY) -> bytes:
+        # Deflate CHUNK_SIZE pieces of the payload independently, pigz style.
+        # Each piece is primed with the 32K of data that precedes it in the
+        # final stream, so back references stay valid.
+        def deflate(start: int) -> bytes:
+            return self.deflate_piece(raw, start, min(start + self.CHUNK_SIZE, len(raw)), level, strategy)
+
+        # zlib releases the GIL while deflating, so threads are enough here
+        with ThreadPoolExecutor(self.threads or None) as pool:
+            body = b''.join(pool.map(deflate, range(0, len(raw), self.CHUNK_SIZE)))
+
+        return self.zlib_header(level) + body + zlib.adler32(raw).to_bytes(4, byteorder='big')
+
+    def zlib_header(self, level: int) -> bytes:
+        # zlib stream header that asks for the V0 dictionary (FDICT)
+        cmf = 0x78  # deflate, 32K window
+        flevel = 0 if level < 2 else 1 if level < 6 else 2 if level == 6 else 3
+        flg = (flevel << 6) | 0x20
+        flg |= 31 - ((cmf << 8) | flg) % 31
+        return bytes([cmf, flg]) + zlib.adler32(UEFIVarStoreV0.dict).to_bytes(4, byteorder='big')
+
+    def compress_incremental(self, raw: bytes, offsets: list, level: int):
+        # Every record (and the leading record count) becomes its own
+        # deflate segment, primed with the 32K that precede it and ended
+        # with a sync flush. A segment depends only on its own record and
+        # that history, so as long as both are unchanged we can splice the
+        # segment from the previous encode (or from the input blob) into the
+        # new output. For the leading run of unchanged segments we also keep
+        # the adler32/crc32c state, so only the rest of the stream needs to
+        # be checksummed again.
+        #
+        # A full flush per record would make segments independent of any
+        # history, but it also throws away the V0 dictionary and roughly
+        # doubles the size of typical stores.
+        if self.source is not None:
+            self.load_segments()
+        old_header, old = self.segments
+        cache = {key: zseg for key, zseg, _, _ in old}
 
-        enc = zlib.compressobj(9, zdict=UEFIVarStoreV0.dict)
-        zdata = enc.compress(raw.file.read()) + enc.flush()
+        header = self.zlib_header(level)
+        adler = 1
+        crc = crc32c.value(U32.pack(0) + header)  # Version 0
+        prefix = header == old_header
+        segments = []
+        bounds = [0] + offsets + [len(raw)]
+        for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+            record = bytes(raw[start:end])
+            if prefix and i < len(old) and old[i][0][1] == record:
+                segments.append(old[i])
+                adler, crc = old[i][2], old[i][3]
+                continue
+            prefix = False
+
+            key = (self.history(raw, start), record)
+            zseg = cache.get(key)
+            if zseg is None:
+                zseg = self.deflate_piece(raw, start, end, level, history=key[0], finish=False)
+            adler = zlib.adler32(record, adler)
+            crc = crc32c.extend(crc, zseg)
+            segments.append((key, zseg, adler, crc))
+        self.segments = (header, segments)
+
+        trailer = self.FINAL_BLOCK + adler.to_bytes(4, byteorder='big')
+        zdata = b''.join([header] + [zseg for _, zseg, _, _ in segments] + [trailer])
+        return zdata, crc32c.extend(crc, trailer)
+
+    def load_segments(self):
+        # Try to recover the segments of an input blob that was itself
+        # written with "incremental". We only know where records start in
+        # the decompressed data, so look for sync flush markers and accept
+        # a segment once it inflates to exactly the record we expect.
+        b64data, offsets = self.source
+        self.source = None
+        zdata = b''.join(self.payload(b64data))
+        raw = memoryview(b''.join(self.inflate([zdata])))
+        header = zdata[:len(self.zlib_header(0))]
+        adler = 1
+        crc = crc32c.value(U32.pack(0) + header)  # Version 0
+        segments = []
+        pos = len(header)
+        bounds = [0] + offsets + [len(raw)]
+        for start, end in zip(bounds, bounds[1:]):
+            key = (self.history(raw, start), raw[start:end].tobytes())
+            search = pos
+            while True:
+                mark = zdata.find(self.FLUSH_MARKER, search)
+                if mark < 0:
+                    return
+                search = mark + len(self.FLUSH_MARKER)
+                try:
+                    out = zlib.decompressobj(-zlib.MAX_WBITS, zdict=key[0]).decompress(zdata[pos:search])
+                except zlib.error:
+                    return
+                if out == key[1]:
+                    break
+                if not key[1].startswith(out):
+                    return
+            zseg = zdata[pos:search]
+            adler = zlib.adler32(key[1], adler)
+            crc = crc32c.extend(crc, zseg)
+            segments.append((key, zseg, adler, crc))
+            pos = search
+        self.segments = (header, segments)
+
+    def encoded_size(self, zdata: bytes) -> int:
+        # Size of the base64 output for a given zlib payload
+        return (AWS_HEADER.size + len(zdata) + 2) // 3 * 4
+
+    def compress_to_budget(self, raw: bytes) -> bytes:
+        # Walk from the cheapest to the most expensive setting and stop at
+        # the first one whose encoded output stays within the budget
+        for level, strategy in self.BUDGET_LADDER:
+            zdata = self.compress(raw, level, strategy)
+            if self.encoded_size(zdata) <= self.budget:
+                print("Compressed with level {} ({})".format(level, self.STRATEGY_NAMES[strategy]),
+                      file=sys.stderr)
+                return zdata
+
+        raise Exception("Can not fit variables into {} bytes (need {})".format(
+            self.budget, self.encoded_size(zdata)))
+
+    def __bytes__(self) -> bytes:
+        # Assemble the zlib compressed wrapped file
+        offsets = []
+        raw = self.pack_records(offsets)
+
+        if self.incremental:
+            zdata, crc = self.compress_incremental(raw, offsets, self.level)
+        else:
+            if self.budget is not None:
+                zdata = self.compress_to_budget(raw)
+            else:
+                zdata = self.compress(raw, self.level)
+            crc = crc32c.value(U32.pack(0) + zdata)  # Version 0
 
         # Create a full file with header + zdata
-        f = tempfile.SpooledTemporaryFile()
-        f = AWSVarStoreFile(f)
-        f.write64(self.AMZNUEFI)
-        f.write32(crc32c.value(int(0).to_bytes(4, byteorder='little') + zdata))
-        f.write32(0)  # Version 0
-        f.write(zdata)
-        f.file.seek(0, os.SEEK_SET)
+        header = AWS_HEADER.pack(self.AMZNUEFI, crc, 0)
 
         # Then write it out as base64 data
-        return base64.b64encode(f.file.read())
+        return base64.b64encode(header + zdata)
+
+    def set_output_options(self, options):
+        for option in [option.strip().split("=") for option in options]:
+            if option[0] in ('level', 'budget', 'threads'):
+                if (len(option) != 2 or not option[1]):
+                    raise SystemExit(
+                        'option "{}" requires a second argument'.format(option[0])
+                    )
+                value = int(option[1])
+                if option[0] == 'level' and not 0 <= value <= 9:
+                    raise SystemExit(
+                        'option "level" must be between 0 and 9'
+                    )
+                setattr(self, option[0], value)
+            elif option[0] == 'incremental':
+                self.incremental = True
+            else:
+                raise SystemExit(
+                    'Unknown Option type "{}"'.format(option)
+                )
+
+        # Incremental output reuses compressed records as they are, so it can
+        # neither recompress them to a budget nor split them across threads
+        if self.incremental and (self.budget is not None or self.threads != 1):
+            raise SystemExit(
+                'option "incremental" does not work with "budget" or "threads"'
+            )
 
     def __str__(self) -> str:
         return self.__bytes__().decode('utf-8')
@@ -3,6 +3,10 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT
 
+import struct
+from .codec import U8, U16, U32, U64
+
+
 class AWSVarStoreFile(object):
     def __init__(self, file):
         self.file = file
@@ -68,3 +72,108 @@ class AWSVarStoreFile(object):
 
     def writetimestamp(self, data):
         return self.write(data)
+
+
+class AWSVarStoreBuffer(object):
+    """
+    Reader with the same interface as AWSVarStoreFile, but backed by an
+    in-memory buffer. Instead of seeking in a file it advances an offset,
+    and read() hands out memoryview slices of the buffer instead of copies.
+
+    If "more" is given, it is an iterator of further chunks of data. They
+    get pulled in only once a read runs past the end of what we have, and
+    data that has already been consumed is dropped at that point.
+    """
+
+    def __init__(self, data, offset: int = 0, more=None):
+        self.view = memoryview(data)
+        self.offset = offset
+        self.base = 0
+        self.more = more
+
+    def tell(self):
+        return self.base + self.offset
+
+    def fill(self, size):
+        if self.more is None:
+            return
+
+        parts = [self.view[self.offset:]]
+        available = len(parts[0])
+        while available < size:
+            chunk = next(self.more, None)
+            if chunk is None:
+                self.more = None
+                break
+            parts.append(chunk)
+            available += len(chunk)
+
+        self.base += self.offset
+        self.view = memoryview(b''.join(parts))
+        self.offset = 0
+
+    def read(self, size):
+        if self.offset + size > len(self.view):
+            self.fill(size)
+        offset = self.offset
+        end = offset + size
+        if end > len(self.view):
+            raise Exception("Unexpected end of buffer at 0x%x" % self.tell())
+        self.offset = end
+        return self.view[offset:end]
+
+    def skip(self, size):
+        # Like read(), but without creating a view or joining chunks
+        while self.offset + size > len(self.view) and self.more is not None:
+            size -= len(self.view) - self.offset
+            self.base += len(self.view)
+            self.offset = 0
+            chunk = next(self.more, None)
+            if chunk is None:
+                self.more = None
+                chunk = b''
+            self.view = memoryview(chunk)
+        if self.offset + size > len(self.view):
+            raise Exception("Unexpected end of buffer at 0x%x" % self.tell())
+        self.offset += size
+
+    def unpack(self, layout: struct.Struct):
+        if self.offset + layout.size > len(self.view):
+            self.fill(layout.size)
+        try:
+            values = layout.unpack_from(self.view, self.offset)
+        except struct.error:
+            raise Exception("Unexpected end of buffer at 0x%x" % self.tell())
+        self.offset += layout.size
+        return values
+
+    def read64(self):
+        return self.unpack(U64)[0]
+
+    def read32(self):
+        return self.unpack(U32)[0]
+
+    def read16(self):
+        return self.unpack(U16)[0]
+
+    def read8(self):
+        return self.unpack(U8)[0]
+
+    def readdata(self, limit: int = None):
+        size = self.unpack(U64)[0]
+        if limit is not None and size > limit:
+            raise Exception("Data of 0x%x bytes at 0x%x exceeds limit of 0x%x" % (size, self.tell(), limit))
+        return self.read(size)
+
+    def readstr(self, limit: int = None):
+        return str(self.readdata(limit), 'utf-8')
+
+    def readguid(self):
+        return self.read(16).tobytes()
+
+    def readtimestamp(self):
+        return self.read(16).tobytes()
+
+    def readall(self):
+        self.fill(float('inf'))
+        return self.read(len(self.view) - self.offset)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT
+
+import hashlib
+import struct
+import sys
+
+# NumPy is optional, and only gets imported once we have a use for it
+numpy = None
+
+# Plain little endian integers
+U8 = struct.Struct('<B')
+U16 = struct.Struct('<H')
+U32 = struct.Struct('<I')
+U64 = struct.Struct('<Q')
+
+# AWS blob header: magic, crc32c, version
+AWS_HEADER = struct.Struct('<QII')
+# AWS records are length prefixed: name and data each start with a u64 size
+AWS_LENGTH = U64
+# AWS record fields after name and data: guid, attr
+AWS_VAR_TAIL = struct.Struct('<16sI')
+# AWS authenticated record fields: timestamp, digest size
+AWS_VAR_AUTH = struct.Struct('<16sQ')
+
+# EDK2 FV header up to the blockmap: zero vector, fs guid, length, signature,
+# attributes, header length, checksum, ext header offset, reserved, revision
+EDK2_FV_HEADER = struct.Struct('<16s16sQ4sIHHHBB')
+# EDK2 FV blockmap entry: block count, block size
+EDK2_BLOCKMAP_ENTRY = struct.Struct('<II')
+# EDK2 varstore header: guid, size, format + state + reserved
+EDK2_VARSTORE_HEADER = struct.Struct('<16sI8s')
+# EDK2 authenticated variable header: start id, state, reserved, attr,
+# monotonic count, timestamp, pubkey index, name size, data size, guid
+EDK2_VAR_HEADER = struct.Struct('<HBBIQ16sIII16s')
+# EDK2 certdb entry: guid, node size, name length (in chars), digest size
+EDK2_CERT_HEADER = struct.Struct('<16sIII')
+
+
+def unpack_from(layout: struct.Struct, buf, offset: int = 0):
+    if offset + layout.size > len(buf):
+        raise Exception("Unexpected end of buffer at 0x%x" % offset)
+    return layout.unpack_from(buf, offset)
+
+
+# Buffers from this size on get summed up with NumPy if it is available
+CSUM16_NUMPY_MIN = 4096
+
+
+def load_numpy():
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+    return numpy
+
+
+def csum16(buf) -> int:
+    # Sum of all little endian 16 bit words in buf, truncated to 16 bits
+    view = memoryview(buf).cast('B')
+    if len(view) & 1:
+        raise Exception("Can not checksum odd length of 0x%x bytes" % len(view))
+    if len(view) >= CSUM16_NUMPY_MIN and load_numpy():
+        return int(numpy.frombuffer(view, dtype='<u2').sum(dtype=numpy.uint64)) & 0xffff
+    if sys.byteorder == 'little':
+        return sum(view.cast('H')) & 0xffff
+    return (sum(view[0::2]) + (sum(view[1::2]) << 8)) & 0xffff
+
+
+def csum16_blocks(buf, blockmap: list, offset: int = 0) -> list:
+    # csum16 of every block of an FV described by blockmap, which is a
+    # list of (block count, block size) tuples
+    view = memoryview(buf).cast('B')
+    csums = []
+    for block_cnt, block_bytes in blockmap:
+        for i in range(block_cnt):
+            csums.append(csum16(view[offset:offset + block_bytes]))
+            offset += block_bytes
+    return csums
+
+
+def block_hashes(buf, blockmap: list, offset: int = 0, end: int = None) -> list:
+    # Digest of every block of an FV described by blockmap, to find the
+    # blocks that differ between two images. With end set, stops after the
+    # block that contains offset end - 1.
+    view = memoryview(buf).cast('B')
+    if end is not None:
+        end += offset
+    hashes = []
+    for block_cnt, block_bytes in blockmap:
+        for i in range(block_cnt):
+            if end is not None and offset >= end:
+                return hashes
+            hashes.append(hashlib.blake2b(view[offset:offset + block_bytes], digest_size=16).digest())
+            offset += block_bytes
+    return hashes
@@ -3,10 +3,18 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT
 
-import struct
-import tempfile
+import bisect
+import hashlib
+import io
+import mmap
 import os
-from .aws_file import AWSVarStoreFile
+import shutil
+import stat
+import sys
+import tempfile
+import traceback
+from .codec import U16, U32, EDK2_FV_HEADER, EDK2_BLOCKMAP_ENTRY, EDK2_VARSTORE_HEADER, EDK2_VAR_HEADER, \
+    EDK2_CERT_HEADER, unpack_from, csum16, block_hashes
 from .varstore import UEFIVar, UEFIVarStore
 
 
@@ -22,54 +30,91 @@ class EDK2CertDB(object):
 
     def __init__(self, uefivar: UEFIVar = None):
         self.certs = []
+        # Contents of the certdb variable we were read from
+        self.raw = None
+        # (name, guid) -> index of the cert that to_var wrote for the variable
+        self.pubkeyidx = {}
         if uefivar is not None:
             self.init_from_var(uefivar)
 
     def init_from_var(self, uefivar: UEFIVar):
-        file = tempfile.SpooledTemporaryFile()
-        file.write(uefivar.data)
-        file.seek(0, os.SEEK_SET)
-        file = AWSVarStoreFile(file)
-        size = file.read32()
-        if size != len(uefivar.data):
+        self.raw = uefivar.data
+        data = memoryview(uefivar.data)
+        size = unpack_from(U32, data)[0]
+        if size != len(data):
             raise Exception("Invalid certdb length")
-        size = size - 4
-
-        while size != 0:
-            guid = file.readguid()
-            cert_node_size = file.read32()
-            cert_node_size  # Unused, silence F841
-            name_size = file.read32() * 2
-            digest_size = file.read32()
-            name = file.read(name_size).decode('utf-16le').rstrip('\0')
-            digest = file.read(digest_size)
+        offset = U32.size
+
+        while offset != size:
+            guid, cert_node_size, name_size, digest_size = unpack_from(EDK2_CERT_HEADER, data, offset)
+            offset += EDK2_CERT_HEADER.size
+            name_size = name_size * 2
+            if offset + name_size + digest_size > size:
+                raise Exception("Invalid certdb entry at 0x%x" % offset)
+            name = str(data[offset:offset + name_size], 'utf-16le').rstrip('\0')
+            offset += name_size
+            digest = data[offset:offset + digest_size].tobytes()
+            offset += digest_size
             self.certs.append(EDK2Cert(name, guid, digest))
-            size = size - (16 + 4 + 4 + 4 + name_size + digest_size)
 
     def to_var(self, vars: UEFIVar):
-        file = tempfile.SpooledTemporaryFile()
-        file = AWSVarStoreFile(file)
-        file.write32(0)  # file size, gets patched in later
-        pubkeyidx = 0
+        entries = []
+        size = U32.size
         for var in vars:
             if not var.digest:
                 continue
+            name = (var.name + '\0').encode('utf-16le')
+            entries.append((var, name))
+            size += EDK2_CERT_HEADER.size + len(name) + len(var.digest)
+
+        data = bytearray(size)
+        U32.pack_into(data, 0, size)
+        offset = U32.size
+        self.pubkeyidx = {}
+        for pubkeyidx, (var, name) in enumerate(entries):
             name_size = len(var.name) + 1
             digest_size = len(var.digest)
-            file.writeguid(var.guid)
-            file.write32(16 + 4 + 4 + 4 + name_size + digest_size)
-            file.write32(name_size)
-            file.write32(digest_size)
-            file.write(var.name.encode('utf-16le') + b'\0\0')
-            file.write(var.digest)
-            var.pubkeyidx = pubkeyidx
-            pubkeyidx = pubkeyidx + 1
-        filesize = file.file.tell()
-        file.file.seek(0, os.SEEK_SET)
-        file.write32(filesize)
-        file.file.seek(0, os.SEEK_SET)
-        data = file.file.read()
-        return UEFIVar("certdb", data, self.GUID_CERTDB, 0x7)
+            EDK2_CERT_HEADER.pack_into(data, offset, var.guid,
+                                       EDK2_CERT_HEADER.size + name_size + digest_size,
+                                       name_size, digest_size)
+            offset += EDK2_CERT_HEADER.size
+            data[offset:offset + len(name)] = name
+            offset += len(name)
+            data[offset:offset + digest_size] = var.digest
+            offset += digest_size
+            self.pubkeyidx[(var.name, var.guid)] = pubkeyidx
+        return UEFIVar("certdb", bytes(data), self.GUID_CERTDB, 0x7)
+
+
+class EDK2VarRecord(object):
+    # Header of one record in an EDK2 variable store. The name only gets
+    # decoded when asked for.
+    def __init__(self, offset: int, state: int, attr: int, timestamp: bytes, namelen: int, datalen: int,
+                 guid: bytes, rawname: bytes):
+        self.offset = offset
+        self.state = state
+        self.attr = attr
+        self.timestamp = timestamp
+        self.namelen = namelen
+        self.datalen = datalen
+        self.guid = guid
+        self.rawname = rawname
+        self._name = None
+
+    @property
+    def name(self) -> str:
+        if self._name is None:
+            self._name = str(self.rawname, 'utf-16le').rstrip('\0')
+        return self._name
+
+    @property
+    def dataoffset(self) -> int:
+        return self.offset + EDK2_VAR_HEADER.size + self.namelen
+
+    @property
+    def size(self) -> int:
+        # Size of the whole record, including padding to the next one
+        return (EDK2_VAR_HEADER.size + self.namelen + self.datalen + 0x3) & ~0x3
 
 
 class EDK2UEFIVarStore(UEFIVarStore):
@@ -77,8 +122,15 @@ class EDK2UEFIVarStore(UEFIVarStore):
     GUID_NVFS = b'\x8d\x2b\xf1\xff\x96\x76\x8b\x4c\xa9\x85\x27\x47\x07\x5b\x4f\x50'
     GUID_VARSTORE = b'\x78\x2c\xf3\xaa\x7b\x94\x9a\x43\xa1\x80\x2e\x14\x4e\xc3\x77\x92'
     STATE_SETTLED = 0x3f
+    STATE_HEADER_VALID_ONLY = 0x7f
+    STATE_IN_DELETED_TRANSITION = 0x3e
+    STATE_DELETED = 0x3c
     VARSTORE_STATUS = b'\x5a\xfe\x00\x00\x00\x00\x00\x00'
     DEFAULT_LENGTH = 540672
+    # Flash sizes filesize=auto picks from: OVMF 128K and 528K. AAVMF pads
+    # a 768K FV of 256K blocks to 64M, with the same variable store size as
+    # OVMF 528K, so it would not fit anything more.
+    STANDARD_LENGTHS = [0x20000, 0x84000]
     EFI_FVB2_READ_DISABLED_CAP  = 0x00000001
     EFI_FVB2_READ_ENABLED_CAP   = 0x00000002
     EFI_FVB2_READ_STATUS        = 0x00000004
@@ -131,60 +183,224 @@ class EDK2UEFIVarStore(UEFIVarStore):
     AAVMF_BLOCK_SIZE            = 0x00040000
     OVMF_BLOCK_SIZE             = 0x00001000
 
+    # Offset of the variable store FV in the file it was read from
+    base = 0
+    # Output option: write into the variable store FV of an existing file
+    inplace = False
+    # Output option: only write the blocks that differ from the output file
+    blockdiff = False
+
     def __init__(self, data):
         super().__init__()
 
         self.certdb = EDK2CertDB()
 
-        # Get a streaming file object
-        file = tempfile.SpooledTemporaryFile()
-        file.write(data)
-        file.seek(0, os.SEEK_SET)
-        file = AWSVarStoreFile(file)
+        # Regular files get mapped rather than read, so we only ever touch
+        # the pages that hold the headers and the live part of the variable
+        # store
+        if isinstance(data, (str, os.PathLike)):
+            with open(data, 'rb') as f:
+                self.parse_mapped(f.fileno())
+        elif isinstance(data, int):
+            self.parse_mapped(data)
+        else:
+            self.base = self.locate(data)
+            self.parse(memoryview(data)[self.base:])
+
+    def parse_mapped(self, fd: int):
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            # Pipes and character devices can not be mapped
+            with open(fd, 'rb', closefd=False) as f:
+                data = f.read()
+            self.base = self.locate(data)
+            self.parse(memoryview(data)[self.base:])
+            return
+
+        flash = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        try:
+            self.base = self.locate(flash)
+            self.parse(memoryview(flash)[self.base:], copy=True)
+        except BaseException as e:
+            # The frames of the traceback still hold views of the mapping,
+            # which would keep it from getting closed
+            traceback.clear_frames(e.__traceback__)
+            raise
+        finally:
+            flash.close()
+
+    @classmethod
+    def locate(cls, buf) -> int:
+        # Returns the offset of the variable store FV in buf, which may be a
+        # complete OVMF/AAVMF firmware image with other FVs around it. Falls
+        # back to 0 if there is no valid one, so parsing reports the error.
+        view = memoryview(buf)
+        if view[16:32] == cls.GUID_NVFS:
+            return 0
+
+        # bytes, bytearray and mmap can search for the FV GUID themselves
+        find = buf.find if hasattr(buf, 'find') else view.tobytes().find
+        offset = find(cls.GUID_NVFS, 16)
+        while offset != -1:
+            base = offset - 16
+            if view[base + 40:base + 44] == b'_FVH':
+                try:
+                    cls.__new__(cls).parse_header(view[base:])
+                    return base
+                except Exception:
+                    pass
+            offset = find(cls.GUID_NVFS, offset + 1)
+        return 0
+
+    @classmethod
+    def scan(cls, data):
+        # Yields an EDK2VarRecord for every record in the variable store in
+        # data (a path, file descriptor or buffer), without touching the
+        # variable data. Only the header fields get set on the store.
+        store = cls.__new__(cls)
+        if isinstance(data, (str, os.PathLike)):
+            with open(data, 'rb') as f:
+                yield from cls.scan(f.fileno())
+        elif isinstance(data, int):
+            flash = mmap.mmap(data, 0, access=mmap.ACCESS_READ)
+            try:
+                store.base = cls.locate(flash)
+                yield from store.records(memoryview(flash)[store.base:])
+            finally:
+                flash.close()
+        else:
+            store.base = cls.locate(data)
+            yield from store.records(memoryview(data)[store.base:])
+
+    def records(self, view: memoryview, offset: int = None):
+        # Yields an EDK2VarRecord for every record in the variable store in
+        # view, all the way to the first unused space in it (self.tail).
+        # offset may point to any record to resume from there.
+        varstart = self.parse_header(view)
+        if offset is None:
+            offset = varstart
+
+        # Records past varsize break the firmware, but older versions of
+        # this tool wrote them, so keep reading to the end of the FV
+        end = self.length
+        overflow = False
+        while offset + U16.size <= end and U16.unpack_from(view, offset)[0] == 0x55aa:
+            if offset + EDK2_VAR_HEADER.size > end:
+                raise Exception("Unexpected end of buffer at 0x%x" % offset)
+            _, state, _, attr, _, timestamp, _, namelen, datalen, guid = \
+                EDK2_VAR_HEADER.unpack_from(view, offset)
+            start = offset + EDK2_VAR_HEADER.size
+            if start + namelen + datalen > end:
+                raise Exception("Unexpected end of buffer at 0x%x" % start)
+            if start + namelen + datalen > self.varend and not overflow:
+                print("Variable store overflows varsize 0x%x at 0x%x" % (self.varsize, offset), file=sys.stderr)
+                overflow = True
+            record = EDK2VarRecord(offset, state, attr, timestamp, namelen, datalen, guid,
+                                   view[start:start + namelen].tobytes())
+            offset += record.size
+            yield record
+        self.tail = offset
+
+    def parse(self, view: memoryview, copy: bool = False):
+        # With copy set, variable data gets copied out of view rather than
+        # referenced, so the caller may release the underlying buffer
+
+        # Extract all variables, indexed by (name, guid) so we can attach the
+        # certdb digests later. Remember where their records live for in
+        # place updates, and how much space live and dead (deleted or half
+        # written) records take.
+        index = {}
+        self.offsets = {}
+        self.live = 0
+        self.dead = 0
+        records = list(self.records(view))
+        live = self.live_records(records)
+        for record in records:
+            if record.offset not in live:
+                self.dead += record.size
+                continue
+            self.live += record.size
+
+            name, guid = record.name, record.guid
+            data = view[record.dataoffset:record.dataoffset + record.datalen]
+            if copy:
+                data = data.tobytes()
+            timestamp = record.timestamp
+            if timestamp == self.EMPTY_TIMESTAMP:
+                timestamp = None
+            var = UEFIVar(name, data, guid, record.attr, timestamp, None)
+            self.offsets[(name, guid)] = record.offset
+            if name == "certdb" and guid == self.GUID_CERTDB:
+                self.certdb = EDK2CertDB(var)
+            else:
+                self.vars.append(var)
+                index[(name, guid)] = var
+
+        # Whatever follows the last record is erased flash
+        self.erased = view[self.tail] if self.tail < self.varend else 0
+
+        # Extract all certdb entries into digest fields
+        for cert in self.certdb.certs:
+            var = index.get((cert.name, cert.guid))
+            if var is not None:
+                var.digest = cert.digest
+
+    def live_records(self, records: list) -> set:
+        # Offsets of the records that hold current variables: settled ones,
+        # and ones caught in deleted transition when no settled copy of the
+        # same variable exists, because the update that was to replace them
+        # got interrupted. The firmware keeps the last of those.
+        settled = set()
+        transition = {}
+        for record in records:
+            if record.state == self.STATE_SETTLED:
+                settled.add((record.name, record.guid))
+            elif record.state == self.STATE_IN_DELETED_TRANSITION:
+                transition[(record.name, record.guid)] = record.offset
+        live = {record.offset for record in records if record.state == self.STATE_SETTLED}
+        live.update(offset for key, offset in transition.items() if key not in settled)
+        return live
+
+    def parse_header(self, view: memoryview) -> int:
+        # Parses and checks the FV and varstore headers, returns the offset
+        # of the first variable record
 
         # Parse FV header
-        zerovector = file.read(0x10)
+        zerovector, fsguid, self.length, sig, self.attrs, hlength, csum_hdr, ext_hdr_offset, reserved, rev = \
+            unpack_from(EDK2_FV_HEADER, view)
         if zerovector != b'\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0\0':
             raise Exception("Invalid Zero Vector: %s" % zerovector)
 
-        fsguid = file.readguid()
         if fsguid != self.GUID_NVFS:
             raise Exception("Invalid GUID: %s" % fsguid)
 
-        self.length = file.read64()
-        if self.length > len(data):
+        if self.length > len(view):
             raise Exception("Invalid length: %s" % self.length)
 
-        sig = file.read(4)
         if sig != b'_FVH':
             raise Exception('Invalid FVH signature: %s' % sig)
 
-        self.attrs = file.read32()
-        hlength = file.read16()
-        csum_hdr = file.read16()
-        if (self.csum16(data[:hlength]) != 0):
+        if (self.csum16(view[:hlength]) != 0):
             raise Exception("Invalid header checksum: 0x%x" % csum_hdr)
 
         # Ensure there isn't an extension header we don't understand
-        ext_hdr_offset = file.read16()
         if ext_hdr_offset != 0:
             raise Exception('FVH with extension header not supported')
 
         # Reserved field (should always be 0)
-        reserved = file.read8()
         if reserved != 0:
             raise Exception('Wrong value for FVH.Reserved: %s' % reserved)
 
         # Read revision
-        rev = file.read8()
         if rev != 0x2:
             raise Exception('Invalid FVH Revision: 0x%x' % rev)
 
         # Read blockmap
         self.blockmap = []
         total_bytes = 0
+        offset = EDK2_FV_HEADER.size
         while True:
-            block_cnt, block_bytes = file.read32(), file.read32()
+            block_cnt, block_bytes = unpack_from(EDK2_BLOCKMAP_ENTRY, view, offset)
+            offset += EDK2_BLOCKMAP_ENTRY.size
             if block_cnt == 0 and block_bytes == 0:
                 break
             self.blockmap.append((block_cnt, block_bytes))
@@ -193,80 +409,47 @@ class EDK2UEFIVarStore(UEFIVarStore):
             raise Exception('Invalid blockmap: %s' % self.blockmap)
 
         # Verify header length (ext headers not supported so must match current pos)
-        if hlength != file.file.tell():
+        if hlength != offset:
             raise Exception('Invalid header length: %s' % hlength)
 
         # Parse varstore header
-        vsguid = file.readguid()
+        vsguid, self.varsize, status = unpack_from(EDK2_VARSTORE_HEADER, view, offset)
+        offset += EDK2_VARSTORE_HEADER.size
         if vsguid != self.GUID_VARSTORE:
             raise Exception('Invalid Varstore GUID: %s' % vsguid)
 
-        self.varsize = file.read32()
-        status = file.read(8)
         if status != self.VARSTORE_STATUS:
             raise Exception('Invalid Varstore Status: %s' % status)
 
-        # Extract all variables
-        while file.read16() == 0x55aa:
-            state = file.read8()
-            file.read8()
-            attr = file.read32()
-            monotoniccount = file.read64()
-            monotoniccount  # Unused, silence F841
-            timestamp = file.readtimestamp()
-            pubkeyidx = file.read32()
-            pubkeyidx  # Unused, silence F841
-            namelen = file.read32()
-            datalen = file.read32()
-            guid = file.readguid()
-            name = file.read(namelen).decode('utf-16le').rstrip('\0')
-            data = file.read(datalen)
-            if state == self.STATE_SETTLED:
-                if timestamp == self.EMPTY_TIMESTAMP:
-                    timestamp = None
-                var = UEFIVar(name, data, guid, attr, timestamp, None)
-                if name == "certdb" and guid == self.GUID_CERTDB:
-                    self.certdb = EDK2CertDB(var)
-                else:
-                    self.vars.append(var)
-            file.file.seek((file.file.tell() + 0x3) & ~0x3, os.SEEK_SET)
-
-        # Extract all certdb entries into digest fields
-        for cert in self.certdb.certs:
-            for var in self.vars:
-                if var.name == cert.name and var.guid == cert.guid:
-                    var.digest = cert.digest
+        # Where records are meant to end
+        self.varstart = offset
+        self.varend = min(hlength + self.varsize, len(view))
+        return offset
 
     def csum16(self, var: bytes):
-        u16 = struct.unpack("<" + str(int(len(var) / 2)) + "H", var)
-        csum = 0
-        for b in u16:
-            # print("0x%x + 0x%x = 0x%x" % (csum, b, csum + b))
-            csum = csum + b
-        return (csum & 0xffff)
-
-    def write_var(self, raw: AWSVarStoreFile, var: UEFIVar):
-        raw.write16(0x55aa)
-        raw.write8(self.STATE_SETTLED)
-        raw.write8(0)
-        raw.write32(var.attr)
-        raw.write64(0)  # monotonic count
-        if var.timestamp:
-            raw.write(var.timestamp)
-        else:
-            raw.write(b'\0' * 16)
-        if hasattr(var, 'pubkeyidx'):
-            raw.write32(var.pubkeyidx)
-        else:
-            raw.write32(0)
-        raw.write32(len(var.name + '\0') * 2)
-        raw.write32(len(var.data))
-        raw.write(var.guid)
-        raw.write((var.name + '\0').encode('utf-16le'))
-        raw.write(var.data)
-        raw.file.seek((raw.file.tell() + 0x3) & ~0x3, os.SEEK_SET)
-
-    def __bytes__(self) -> bytes:
+        return csum16(var)
+
+    def var_size(self, var: UEFIVar) -> int:
+        # Size of the variable record, including padding to the next one
+        name_size = (len(var.name) + 1) * 2
+        return (EDK2_VAR_HEADER.size + name_size + len(var.data) + 0x3) & ~0x3
+
+    def write_var(self, buf, offset: int, var: UEFIVar) -> int:
+        # Packs var into buf at offset and returns the offset of the next one
+        name = (var.name + '\0').encode('utf-16le')
+        EDK2_VAR_HEADER.pack_into(buf, offset, 0x55aa, self.STATE_SETTLED, 0, var.attr,
+                                  0,  # monotonic count
+                                  var.timestamp or self.EMPTY_TIMESTAMP,
+                                  self.certdb.pubkeyidx.get((var.name, var.guid), 0),
+                                  len(name), len(var.data), var.guid)
+        offset += EDK2_VAR_HEADER.size
+        buf[offset:offset + len(name)] = name
+        offset += len(name)
+        buf[offset:offset + len(var.data)] = var.data
+        offset += len(var.data)
+        return (offset + 0x3) & ~0x3
+
+    def set_defaults(self):
         if not hasattr(self, 'certdb'):
             self.certdb = EDK2CertDB()
         if not hasattr(self, 'length'):
@@ -289,71 +472,293 @@ class EDK2UEFIVarStore(UEFIVarStore):
                 self.EFI_FVB2_WRITE_LOCK_STATUS | \
                 self.EFI_FVB2_ALIGNMENT_16
         if not hasattr(self, 'varsize'):
-            self.varsize = int(self.length / 2) - 8264
+            self.varsize = self.default_varsize(self.length)
         if not hasattr(self, 'blockmap'):
             # What is a sensible default here? Examples:
             # - AAVMF uses 256K blocks (virtual NOR)
             # - OVMF uses 4K blocks (page size)
             self.blockmap = [(self.length // self.OVMF_BLOCK_SIZE, self.OVMF_BLOCK_SIZE)]
 
-        # Assemble the flash file
-        raw = AWSVarStoreFile(tempfile.SpooledTemporaryFile())
-
-        # Write FV header
-        raw.write(b'\0' * 16)
-        raw.write(self.GUID_NVFS)
-        raw.write64(self.length)
-        raw.write(b'_FVH')
-        raw.write32(self.attrs)
-        # Leave room for header length
-        hlength_pos = raw.file.tell()
-        raw.write16(0)
-        # Skip checksum - need to fill in later
-        csum_pos = raw.file.tell()
-        raw.write16(0)
-        # No ext header offset + set reversed byte to 0
-        raw.write(b'\0' * 3)
-        # Revision
-        raw.write8(0x2)
-        # Blockmap
+    @staticmethod
+    def default_varsize(length: int) -> int:
+        return int(length / 2) - 8264
+
+    def set_length(self, length: int):
+        # The variable store size and blockmap follow from the length
+        self.length = length
+        for attr in ('varsize', 'blockmap'):
+            if hasattr(self, attr):
+                delattr(self, attr)
+        self.set_defaults()
+
+    def header_length(self) -> int:
+        return EDK2_FV_HEADER.size + EDK2_BLOCKMAP_ENTRY.size * (len(self.blockmap) + 1)
+
+    def size(self, certdb: UEFIVar = None) -> int:
+        # Exact size of the populated part of the flash file: FV header and
+        # blockmap, varstore header, certdb and all variables with padding
+        self.set_defaults()
+        if certdb is None:
+            certdb = self.certdb.to_var(self.vars)
+        size = self.header_length() + EDK2_VARSTORE_HEADER.size + self.var_size(certdb)
+        for var in self.vars:
+            size += self.var_size(var)
+        return size
+
+    def fits(self, size: int) -> bool:
+        return size <= self.length and size - self.header_length() <= self.varsize
+
+    def auto_length(self):
+        # Picks the smallest standard flash size the variables fit into
+        for length in self.STANDARD_LENGTHS:
+            self.set_length(length)
+            size = self.size()
+            if self.fits(size):
+                return
+        raise Exception("Can not fit %d bytes of variables into any standard store size, "
+                        "the largest one holds %d" % (size, self.header_length() + self.varsize))
+
+    def pack(self):
+        # Assembles the flash file in one preallocated buffer. Returns the
+        # buffer and the size of its populated region; everything after it
+        # stays zero.
+        self.set_defaults()
+
+        certdb = self.certdb.to_var(self.vars)
+        hlength = self.header_length()
+        end = self.size(certdb)
+
+        # Make sure it all fits before we allocate anything
+        if not self.fits(end):
+            raise Exception("Can not fit variables into store")
+
+        buf = bytearray(self.length)
+
+        # Write FV header, leaving the checksum at 0 for now
+        EDK2_FV_HEADER.pack_into(buf, 0, b'\0' * 16, self.GUID_NVFS, self.length, b'_FVH',
+                                 self.attrs, hlength, 0, 0, 0, 0x2)
+        offset = EDK2_FV_HEADER.size
         for block_cnt, block_bytes in self.blockmap:
-            raw.write32(block_cnt)
-            raw.write32(block_bytes)
-        raw.write32(0)
-        raw.write32(0)
-        # Write header length
-        hlength = raw.file.tell()
-        raw.file.seek(hlength_pos, os.SEEK_SET)
-        raw.write16(hlength)
-        # Checksum
-        raw.file.seek(0, os.SEEK_SET)
-        fvh = raw.file.read(hlength)
-        raw.file.seek(csum_pos, os.SEEK_SET)
-        raw.write16((0x10000 - self.csum16(fvh) & 0xffff))
-        # Go to end of FV header
-        raw.file.seek(hlength, os.SEEK_SET)
+            EDK2_BLOCKMAP_ENTRY.pack_into(buf, offset, block_cnt, block_bytes)
+            offset += EDK2_BLOCKMAP_ENTRY.size
+        # Checksum (lives at offset 0x32 of the FV header)
+        U16.pack_into(buf, 0x32, (0x10000 - self.csum16(buf[:hlength]) & 0xffff))
 
         # Write varstore header
-        raw.write(self.GUID_VARSTORE)
-        raw.write32(self.varsize)
-        raw.write(self.VARSTORE_STATUS)
+        EDK2_VARSTORE_HEADER.pack_into(buf, hlength, self.GUID_VARSTORE, self.varsize, self.VARSTORE_STATUS)
+        offset = hlength + EDK2_VARSTORE_HEADER.size
 
         # Write variables
-        self.write_var(raw, self.certdb.to_var(self.vars))
-
+        offset = self.write_var(buf, offset, certdb)
         for var in self.vars:
-            self.write_var(raw, var)
+            offset = self.write_var(buf, offset, var)
 
-        # Make sure it all fits
-        if raw.file.tell() > self.length:
-            raise Exception("Can not fit variables into store")
+        return buf, end
+
+    def to_buffer(self) -> memoryview:
+        return memoryview(self.pack()[0])
 
-        # Expand to maximum file size
-        raw.file.seek(self.length - 1, os.SEEK_SET)
-        raw.write8(0)
+    def __bytes__(self) -> bytes:
+        return bytes(self.to_buffer())
+
+    def open_output(self, path):
+        if self.inplace or (self.blockdiff and os.path.exists(path)):
+            return open(path, 'r+b')
+        if self.blockdiff:
+            return open(path, 'w+b')
+        return super().open_output(path)
+
+    def write(self, outfile):
+        if self.inplace:
+            return self.write_inplace(outfile)
+
+        buf, end = self.pack()
+        if self.blockdiff:
+            if not outfile.seekable():
+                raise SystemExit('option "blockdiff" requires an output file')
+            # Anything the file does not have yet reads as zero (and stays a
+            # hole if we do not write to it)
+            outfile.truncate(self.length)
+            self.base = 0
+            return self.write_blocks(outfile, buf)
+        outfile.write(memoryview(buf)[:end])
+
+        # Regular files get the erased tail as a hole instead of zeros
+        try:
+            sparse = stat.S_ISREG(os.fstat(outfile.fileno()).st_mode)
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            sparse = False
+        if sparse:
+            outfile.flush()
+            os.ftruncate(outfile.fileno(), outfile.tell() + self.length - end)
+        else:
+            outfile.write(memoryview(buf)[end:])
+
+    def write_inplace(self, outfile):
+        # Replaces the variable store FV in an existing file, which may be a
+        # complete firmware image, keeping the geometry of the FV there
+        if not outfile.seekable():
+            raise SystemExit('option "inplace" requires an output file')
+        flash = mmap.mmap(outfile.fileno(), 0, access=mmap.ACCESS_READ)
+        self.base = self.locate(flash)
+        self.parse_header(memoryview(flash)[self.base:])
+        flash.close()
+
+        buf, end = self.pack()
+        if self.blockdiff:
+            return self.write_blocks(outfile, buf)
+        outfile.seek(self.base, os.SEEK_SET)
+        outfile.write(buf)
+
+    def write_blocks(self, outfile, buf: bytearray):
+        # Writes only the blocks of the image in buf that differ from the
+        # ones at self.base in outfile, and reports their indices
+        fd = outfile.fileno()
+        flash = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        old = block_hashes(flash, self.blockmap, self.base)
+        flash.close()
+        new = block_hashes(buf, self.blockmap)
+
+        view = memoryview(buf)
+        self.dirty_blocks = []
+        index = 0
+        offset = 0
+        for block_cnt, block_bytes in self.blockmap:
+            for i in range(block_cnt):
+                if old[index] != new[index]:
+                    os.pwrite(fd, view[offset:offset + block_bytes], self.base + offset)
+                    self.dirty_blocks.append(index)
+                index += 1
+                offset += block_bytes
+
+        blocks = ''.join(' {}'.format(i) for i in self.dirty_blocks)
+        print('Wrote {} of {} blocks{}'.format(len(self.dirty_blocks), index, blocks and ':' + blocks), file=sys.stderr)
+
+    def update(self, path, vars: list):
+        # Updates the flash file at path, which this store was read from, in
+        # place: vars get appended as new records after the last one and the
+        # records they replace get marked deleted, the way the firmware does
+        # it. Everything else in the file stays untouched.
+        certdb = self.certdb.to_var(self.vars)
+        if certdb.data != self.certdb.raw:
+            vars = vars + [certdb]
+
+        size = sum(self.var_size(var) for var in vars)
+        if self.tail + size > self.varend and self.tail + size - self.dead <= self.varend:
+            # Make room the same way the firmware would
+            self.reclaim(path)
+        if self.tail + size > self.varend:
+            raise Exception("Can not fit variables into store")
 
-        raw.file.seek(0, os.SEEK_SET)
-        return raw.file.read()
+        fd = os.open(path, os.O_RDWR)
+        try:
+            for var in vars:
+                key = (var.name, var.guid)
+                old = self.offsets.get(key)
+                record = bytearray(self.var_size(var))
+                self.write_var(record, 0, var)
+                record[2] = self.STATE_HEADER_VALID_ONLY
+
+                # Same order as the firmware: until the new record is
+                # settled, the old one stays live in deleted transition, so
+                # an interrupted update leaves either the old or the new
+                # variable behind
+                if old is not None:
+                    os.pwrite(fd, bytes([self.STATE_IN_DELETED_TRANSITION]), self.base + old + 2)
+                os.pwrite(fd, record, self.base + self.tail)
+                os.pwrite(fd, bytes([self.STATE_SETTLED]), self.base + self.tail + 2)
+                if old is not None:
+                    os.pwrite(fd, bytes([self.STATE_DELETED]), self.base + old + 2)
+                    old_size = self.record_size(fd, old)
+                    self.live -= old_size
+                    self.dead += old_size
+
+                self.offsets[key] = self.tail
+                self.tail += len(record)
+                self.live += len(record)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.certdb.raw = certdb.data
+
+    def record_size(self, fd: int, offset: int) -> int:
+        # Size of the record at offset in fd, including padding
+        namelen, datalen = EDK2_VAR_HEADER.unpack(os.pread(fd, EDK2_VAR_HEADER.size, self.base + offset))[7:9]
+        return (EDK2_VAR_HEADER.size + namelen + datalen + 0x3) & ~0x3
+
+    def reclaim(self, path):
+        # Compacts the variable store in the flash file at path, which this
+        # store was read from, like the firmware's Reclaim(): live records
+        # get moved to the front in their current order, unchanged apart
+        # from settling ones kept from interrupted updates, and the space of
+        # dead records is erased. The firmware goes through its spare block
+        # so it can not lose variables half way, we write a copy of the file
+        # and rename it over the original.
+        with open(path, 'rb') as f:
+            old = os.pread(f.fileno(), self.tail - self.varstart, self.base + self.varstart)
+        buf = bytearray(bytes([self.erased]) * len(old))
+        offsets = {}
+        offset = 0
+        for key, start in sorted(self.offsets.items(), key=lambda item: item[1]):
+            start -= self.varstart
+            namelen, datalen = EDK2_VAR_HEADER.unpack_from(old, start)[7:9]
+            size = (EDK2_VAR_HEADER.size + namelen + datalen + 0x3) & ~0x3
+            buf[offset:offset + size] = old[start:start + size]
+            # A record kept from an interrupted update is current now
+            buf[offset + 2] = self.STATE_SETTLED
+            offsets[key] = self.varstart + offset
+            offset += size
+
+        self.replace_file(path, buf, self.base + self.varstart)
+        self.offsets = offsets
+        self.tail = self.varstart + offset
+        self.live = offset
+        self.dead = 0
+
+    @classmethod
+    def replace_file(cls, path, buf, offset: int):
+        # Atomically replaces the file at path with a copy that has buf at
+        # offset. Blocks of zeros stay holes, like in the files we write.
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmppath = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', dir=directory)
+        try:
+            with open(path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+                zeros = bytes(cls.OVMF_BLOCK_SIZE)
+                for block in iter(lambda: src.read(cls.OVMF_BLOCK_SIZE), b''):
+                    if block == zeros[:len(block)]:
+                        dst.seek(len(block), os.SEEK_CUR)
+                    else:
+                        dst.write(block)
+                dst.truncate()
+                dst.flush()
+                os.pwrite(dst.fileno(), buf, offset)
+                os.fsync(dst.fileno())
+            shutil.copymode(path, tmppath)
+            os.replace(tmppath, path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+
+        # Make the rename itself durable
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def stats(self) -> dict:
+        # Space usage of the variable store. largest is the biggest name plus
+        # data that still fits, right now and after a reclaim.
+        free = self.varend - self.tail
+        return {
+            'vars': len(self.offsets),
+            'live': self.live,
+            'dead': self.dead,
+            'free': max(free, 0),
+            'size': self.varend - self.varstart,
+            'largest': max((free & ~0x3) - EDK2_VAR_HEADER.size, 0),
+            'largest_reclaimed': max(((free + self.dead) & ~0x3) - EDK2_VAR_HEADER.size, 0),
+        }
 
     def set_output_options(self, options):
         for option in [option.strip().split("=") for option in options]:
@@ -362,8 +767,116 @@ class EDK2UEFIVarStore(UEFIVarStore):
                     raise SystemExit(
                         'option "filesize" requires a second argument'
                     )
-                self.length = int(option[1]) * 1024
+                if option[1] == 'auto':
+                    self.auto_length()
+                else:
+                    self.set_length(int(option[1]) * 1024)
+            elif option[0] == 'inplace':
+                self.inplace = True
+            elif option[0] == 'blockdiff':
+                self.blockdiff = True
             else:
                 raise SystemExit(
                     'Unknown Option type "{}"'.format(option)
                 )
+
+
+class EDK2Watch(object):
+    # Follows the variable store in an EDK2 flash file while something else,
+    # like a running VM, writes to it. Every poll only looks at the file if
+    # its mtime or size changed, and then only re-parses the records from
+    # the first changed block of the variable store on.
+    def __init__(self, path):
+        self.path = path
+        self.stat = None
+        self.store = EDK2UEFIVarStore.__new__(EDK2UEFIVarStore)
+        self.hashes = []
+        # All records in the store, live or not, in store order
+        self.records = []
+        # (name, guid) -> (record, hash of attr and data) of live variables
+        self.vars = {}
+        self.poll()
+
+    def poll(self) -> list:
+        # Returns (event, name, guid, var) tuples for every variable that got
+        # "added", "modified" or "deleted" since the last poll. var is None
+        # for deleted variables.
+        st = os.stat(self.path)
+        stat = (st.st_mtime_ns, st.st_size)
+        if stat == self.stat:
+            return []
+
+        with open(self.path, 'rb') as f:
+            flash = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            events = self.update(memoryview(flash)[self.store.locate(flash):])
+        except BaseException as e:
+            # See EDK2UEFIVarStore.parse_mapped()
+            traceback.clear_frames(e.__traceback__)
+            raise
+        finally:
+            flash.close()
+        self.stat = stat
+        return events
+
+    def update(self, view: memoryview) -> list:
+        # Nothing gets remembered unless the whole update succeeds, so a
+        # failed one gets retried from scratch by the next poll
+        store = self.store
+        store.parse_header(view)
+        hashes = block_hashes(view, store.blockmap, 0, store.varend)
+
+        # Find the first block that changed
+        dirty = 0
+        while dirty < min(len(hashes), len(self.hashes)) and hashes[dirty] == self.hashes[dirty]:
+            dirty += 1
+        if dirty == len(hashes) == len(self.hashes):
+            return []
+        dirty = sum(self.block_sizes(dirty))
+
+        # Records before the last one that starts in front of the first
+        # changed block stay as they are, everything after gets re-read
+        offsets = [record.offset for record in self.records]
+        keep = bisect.bisect_right(offsets, dirty) - 1
+        if keep < 0:
+            keep = 0
+            records = list(store.records(view))
+        else:
+            records = self.records[:keep] + list(store.records(view, offsets[keep]))
+
+        events = []
+        live = {}
+        current = store.live_records(records)
+        for record in records:
+            if record.offset not in current:
+                continue
+            key = (record.name, record.guid)
+            old = self.vars.get(key)
+            if old is not None and old[0] is record:
+                live[key] = old
+                continue
+
+            data = view[record.dataoffset:record.dataoffset + record.datalen].tobytes()
+            digest = hashlib.blake2b(U32.pack(record.attr) + data, digest_size=16).digest()
+            live[key] = (record, digest)
+            if old is None or old[1] != digest:
+                timestamp = record.timestamp
+                if timestamp == store.EMPTY_TIMESTAMP:
+                    timestamp = None
+                var = UEFIVar(record.name, data, record.guid, record.attr, timestamp)
+                events.append(('added' if old is None else 'modified', record.name, record.guid, var))
+
+        for key in self.vars:
+            if key not in live:
+                events.append(('deleted', key[0], key[1], None))
+        self.hashes = hashes
+        self.records = records
+        self.vars = live
+        return events
+
+    def block_sizes(self, count: int) -> list:
+        # Sizes of the first count blocks of the FV
+        sizes = []
+        for block_cnt, block_bytes in self.store.blockmap:
+            sizes += [block_bytes] * min(block_cnt, count - len(sizes))
+        return sizes
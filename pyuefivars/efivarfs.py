@@ -4,6 +4,7 @@
 # SPDX-License-Identifier: MIT
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 from .varstore import UEFIVar, UEFIVarStore
 import uuid
 import sys
@@ -20,6 +21,9 @@ class EFIVARFSUEFIVarStore(UEFIVarStore):
     metadata such as secure variable details are not readable through efivarfs.
     """
 
+    # Every read is a round trip to the firmware, so do a few at once
+    READ_THREADS = 8
+
     def __init__(self, path):
         super().__init__()
         self.is_empty = False
@@ -30,35 +34,51 @@ class EFIVARFSUEFIVarStore(UEFIVarStore):
         if not os.path.isdir(path):
             raise Exception(f'"{path}" is not a valid efivarfs path')
 
-        var_names = os.listdir(path)
-        # example:  'X-Nitro-BootServicesExited-8be4df61-93ca-11d2-aa0d-00e098032b8c'
+        entries = []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_file():
+                    entries.append(self.parse_name(entry.name) + (entry.path,))
+        entries.sort()
+
+        with ThreadPoolExecutor(max(min(self.READ_THREADS, len(entries)), 1)) as executor:
+            contents = executor.map(self.read_file, [path for name, guid, var_name, path in entries])
 
-        for var_name in var_names:
-            # efivarfs file name are f'{name}-{guid}'
-            s = var_name.split('-')
+            for (name, guid, var_name, path), content in zip(entries, contents):
+                # efivarfs file contents are f'{attr.le32}{data}'
+                data = content[4:]
+                attr = int.from_bytes(content[:4], "little")
 
-            try:
-                # The last 5 elements make up the GUID
-                guid = uuid.UUID('-'.join(s[-5:])).bytes_le
-            except ValueError:
-                raise Exception(f'Invalid efivarfs file "{var_name}"')
+                # UEFI Secure Boot variables are special; they contain hidden
+                # key material that we can not extract from efivarfs. Skip them.
+                if attr & EFI_VARIABLE_TIME_BASED_AUTHENTICATED_WRITE_ACCESS:
+                    print(f'Skipping authenticated variable "{var_name}"', file=sys.stderr)
+                    continue
+
+                # Now that we reassembled everything, remember the variable
+                self.vars.append(UEFIVar(name, data, guid, attr))
+
+    @staticmethod
+    def parse_name(var_name: str) -> tuple:
+        # example:  'X-Nitro-BootServicesExited-8be4df61-93ca-11d2-aa0d-00e098032b8c'
+        # efivarfs file name are f'{name}-{guid}'
+        s = var_name.split('-')
 
-            # Anything before that is the name of the variable
-            name = '-'.join(s[:-5])
+        try:
+            # The last 5 elements make up the GUID
+            guid = uuid.UUID('-'.join(s[-5:])).bytes_le
+        except ValueError:
+            raise Exception(f'Invalid efivarfs file "{var_name}"')
 
-            # efivarfs file contents are f'{attr.le32}{data}'
-            content = open(os.path.join(path, var_name), 'rb').read()
-            data = content[4:]
-            attr = int.from_bytes(content[:4], "little")
+        # Anything before that is the name of the variable
+        name = '-'.join(s[:-5])
 
-            # UEFI Secure Boot variables are special; they contain hidden
-            # key material that we can not extract from efivarfs. Skip them.
-            if attr & EFI_VARIABLE_TIME_BASED_AUTHENTICATED_WRITE_ACCESS:
-                print(f'Skipping authenticated variable "{var_name}"', file=sys.stderr)
-                continue
+        return (name, guid, var_name)
 
-            # Now that we reassembled everything, remember the variable
-            self.vars.append(UEFIVar(name, data, guid, attr))
+    @staticmethod
+    def read_file(path: str) -> bytes:
+        with open(path, 'rb') as f:
+            return f.read()
 
     def __str__(self) -> str:
         raise Exception('Unable to serialize efivarfs into a file')
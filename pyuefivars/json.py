@@ -3,23 +3,35 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT
 
+import binascii
+import codecs
 import json
+import re
 import uuid
+from json.encoder import encode_basestring_ascii
 from .varstore import UEFIVar, UEFIVarStore
 
 
+# How binary fields get turned into JSON strings and back
+ENCODINGS = {
+    'hex': (bytes.hex, bytes.fromhex),
+    'base64': (lambda data: binascii.b2a_base64(data, newline=False).decode('ascii'), binascii.a2b_base64),
+}
+
+
 class JSONVar(UEFIVar):
-    def __init__(self, jvar):
+    def __init__(self, jvar, encoding: str = 'hex'):
+        decode = ENCODINGS[encoding][1]
         name = jvar['name']
-        data = bytes.fromhex(jvar['data'])
+        data = decode(jvar['data'])
         guid = uuid.UUID(jvar['guid']).bytes_le
         attr = int(jvar['attr'])
         timestamp = None
         digest = None
         if 'timestamp' in jvar:
-            timestamp = bytes.fromhex(jvar['timestamp'])
+            timestamp = decode(jvar['timestamp'])
         if 'digest' in jvar:
-            digest = bytes.fromhex(jvar['digest'])
+            digest = decode(jvar['digest'])
         super().__init__(name, data, guid, attr, timestamp, digest)
 
     def __dict__(self):
@@ -27,35 +39,123 @@ class JSONVar(UEFIVar):
 
 
 class JSONUEFIVarStore(UEFIVarStore):
-    current_version = 2
+    current_version = 3
+    # Output options. Hex encoded output stays at version 2, so older
+    # versions of this tool can read it.
+    encoding = 'hex'
+    compact = False
+    # Members of prepare()d variables that need no escaping
+    PLAIN = ('guid', 'data', 'timestamp', 'digest')
+    # Input gets decoded and parsed in pieces of this many bytes
+    CHUNK_SIZE = 1024 * 1024
 
     def __init__(self, data):
         super().__init__()
 
-        # Read the JSON file
-        jdata = json.loads(data.decode('utf-8'))
-        vardata = []
-        if isinstance(jdata, list):
-            self.version = 1
-            vardata = jdata
+        self.version = self.current_version
+        for key, value in self.read_document(data):
+            if key == 'version':
+                self.version = value
+            elif key == 'variable':
+                self.vars.append(value)
+
+    @classmethod
+    def iter_vars(cls, data):
+        # Like the constructor, but hand out variables as they get parsed
+        for key, value in cls.read_document(data):
+            if key == 'variable':
+                yield value
+
+    @classmethod
+    def read_document(cls, data):
+        # Parses the JSON document in data (bytes or a binary file) one array
+        # element at a time. Yields ("version", version) and then
+        # ("variable", UEFIVar) for every variable.
+        reader = JSONReader(cls.read_chunks(data))
+        encoding = 'hex'
+        c = reader.peek()
+        if c == '[':
+            # Version 1 was a plain list of variables
+            yield ('version', 1)
+            yield from cls.read_variables(reader, encoding)
+        elif reader.next_char() != '{':
+            reader.error('Expecting value')
+        elif reader.peek() == '}':
+            reader.next_char()
         else:
-            self.version = jdata.get('version', self.current_version)
-            vardata = jdata.get('variables', [])
-
-        if self.version > self.current_version:
-            raise SystemExit(
-                'Unknown Version "{}", this tool only supports up to version "{}"'.format(
-                    self.version, self.current_version)
-            )
-
-        # Copy all JSON elements to the UEFIVars for the store
-        for jvar in vardata:
-            new_var = JSONVar(jvar)
+            variables = False
+            while True:
+                key = reader.value()
+                reader.expect(':')
+                if key == 'variables':
+                    yield from cls.read_variables(reader, encoding)
+                    variables = True
+                elif key == 'encoding':
+                    # Version 3: how binary fields are stored. Variables get
+                    # decoded as they are read, so this has to come first.
+                    encoding = reader.value()
+                    if encoding not in ENCODINGS:
+                        raise SystemExit('Unknown encoding "{}"'.format(encoding))
+                    if variables:
+                        raise SystemExit('"encoding" has to come before "variables"')
+                else:
+                    value = reader.value()
+                    if key == 'version':
+                        if value > cls.current_version:
+                            raise SystemExit(
+                                'Unknown Version "{}", this tool only supports up to version "{}"'.format(
+                                    value, cls.current_version)
+                            )
+                        yield ('version', value)
+                if reader.expect(',}') == '}':
+                    break
+        reader.expect('')
+
+    @classmethod
+    def read_variables(cls, reader, encoding: str):
+        # Copy all JSON elements to the UEFIVars for the store. Arrays that
+        # are in the buffer already get parsed in one go, larger ones one
+        # element at a time.
+        if reader.peek() != '[':
+            reader.error("Expecting '['")
+        jvars = reader.buffered_value()
+        if jvars is not None:
+            for jvar in jvars:
+                new_var = JSONVar(jvar, encoding)
+                new_var.__class__ = UEFIVar
+                yield ('variable', new_var)
+            return
+
+        reader.next_char()
+        if reader.peek() == ']':
+            reader.next_char()
+            return
+        while True:
+            new_var = JSONVar(reader.value(), encoding)
             new_var.__class__ = UEFIVar
-            self.vars.append(new_var)
+            yield ('variable', new_var)
+            if reader.expect(',]') == ']':
+                return
+
+    @classmethod
+    def read_chunks(cls, data):
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        if hasattr(data, 'read'):
+            chunks = iter(lambda: data.read(cls.CHUNK_SIZE), b'')
+        else:
+            view = memoryview(data)
+            chunks = (view[i:i + cls.CHUNK_SIZE] for i in range(0, len(view), cls.CHUNK_SIZE))
+        for chunk in chunks:
+            yield decoder.decode(chunk)
+        yield decoder.decode(b'', final=True)
 
     def __bytes__(self):
-        return self.__str__().encode('utf-8')
+        return b''.join(self.chunks())
+
+    def write(self, outfile):
+        # One variable at a time, rather than the whole document at once
+        for chunk in self.chunks():
+            outfile.write(chunk)
 
     def prepare(self, var):
         new_var = var.__dict__()
@@ -63,16 +163,172 @@ class JSONUEFIVarStore(UEFIVarStore):
         if 'guid' in new_var:
             new_var["guid"] = str(uuid.UUID(bytes_le=var.guid))
 
+        encode = ENCODINGS[self.encoding][0]
         for key in new_var:
             if isinstance(new_var[key], bytes):
-                new_var[key] = new_var[key].hex()
+                new_var[key] = encode(new_var[key])
 
         return new_var
 
+    def chunks(self):
+        # Pieces of the same document json.dumps() would produce for the
+        # whole store, with indent=4 unless compact
+        header = {"version": 2 if self.encoding == 'hex' else self.current_version}
+        if self.encoding != 'hex':
+            header["encoding"] = self.encoding
+
+        if self.compact:
+            yield json.dumps(header, separators=(',', ':'))[:-1].encode('utf-8') + b',"variables":['
+            separator = b''
+            for var in self.vars:
+                yield separator + self.dump_var(self.prepare(var))
+                separator = b','
+            yield b']}'
+            return
+
+        yield json.dumps(header, indent=4)[:-2].encode('utf-8') + b',\n    "variables": ['
+        separator = b'\n'
+        for var in self.vars:
+            yield separator + self.dump_var(self.prepare(var))
+            separator = b',\n'
+        yield b'\n    ]\n}' if self.vars else b']\n}'
+
+    def dump_var(self, jvar: dict) -> bytes:
+        # A variable as it appears in the "variables" array, written out the
+        # same as json.dumps() would. Variables are flat, and the fields
+        # prepare() encoded are plain ASCII, so only the others need escaping.
+        colon = ':' if self.compact else ': '
+        members = []
+        for key, value in jvar.items():
+            if key in self.PLAIN:
+                value = '"' + value + '"'
+            elif isinstance(value, str):
+                value = encode_basestring_ascii(value)
+            elif type(value) is int:
+                value = int.__repr__(value)
+            else:
+                value = json.dumps(value)
+            members.append(encode_basestring_ascii(key) + colon + value)
+        if self.compact:
+            out = '{' + ','.join(members) + '}'
+        elif members:
+            out = '        {\n            ' + ',\n            '.join(members) + '\n        }'
+        else:
+            out = '        {}'
+        return out.encode('ascii')
+
+    def set_output_options(self, options):
+        for option in [option.strip() for option in options]:
+            if option in ENCODINGS:
+                self.encoding = option
+            elif option == 'compact':
+                self.compact = True
+            else:
+                raise SystemExit(
+                    'Unknown Option type "{}"'.format(option)
+                )
+
     def __str__(self):
-        encoded_vars = list(map(self.prepare, self.vars))
-        store = {
-            "version": self.current_version,
-            "variables": encoded_vars,
-        }
-        return json.dumps(store, indent=4)
+        return bytes(self).decode('utf-8')
+
+
+def JSONEvent(event: str, name: str, guid: bytes, var: UEFIVar = None) -> str:
+    # One line of JSON describing a change to a variable
+    jevent = {
+        "event": event,
+        "name": name,
+        "guid": str(uuid.UUID(bytes_le=guid)),
+    }
+    if var is not None:
+        jevent["attr"] = var.attr
+        jevent["data"] = var.data.hex()
+    return json.dumps(jevent)
+
+
+class JSONReader(object):
+    # Pulls JSON values out of a stream of text chunks with raw_decode, so
+    # only the value being parsed has to be in memory
+    NONSPACE = re.compile(r'[^ \t\n\r]')
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size: int = 1) -> bool:
+        # Appends chunks to the buffer until at least size more characters
+        # came in, dropping what was consumed. The chunks get joined once, so
+        # growing the buffer stays linear. Returns whether anything came in.
+        chunks = [self.buf[self.pos:]]
+        added = 0
+        for chunk in self.chunks:
+            chunks.append(chunk)
+            added += len(chunk)
+            if added >= size:
+                break
+        else:
+            self.eof = True
+        self.buf = ''.join(chunks)
+        self.pos = 0
+        return added > 0
+
+    def peek(self) -> str:
+        # Returns the next character that is not whitespace, without
+        # consuming it ('' at the end of the input)
+        while True:
+            match = self.NONSPACE.search(self.buf, self.pos)
+            if match is not None:
+                self.pos = match.start()
+                return self.buf[self.pos]
+            self.pos = len(self.buf)
+            if not self.fill():
+                return ''
+
+    def next_char(self) -> str:
+        c = self.peek()
+        self.pos += len(c)
+        return c
+
+    def expect(self, chars: str) -> str:
+        # Consumes the next character, which has to be one of chars ('' for
+        # the end of the input)
+        c = self.next_char()
+        if c not in chars or (c == '' and chars):
+            if c:
+                self.pos -= 1
+            self.error('Expecting ' + ' or '.join(repr(c) for c in chars) if chars else 'Extra data')
+        return c
+
+    def value(self):
+        # Parses the next value. It only counts as complete once there is
+        # input after it, so numbers can not get cut in half. Values that
+        # span chunks get retried with twice as much input each time.
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill(len(self.buf) - self.pos)
+
+    def buffered_value(self):
+        # Parses the next value if all of it is in the buffer already.
+        # Returns None, with nothing consumed, if it is not.
+        self.peek()
+        try:
+            value, end = self.decoder.raw_decode(self.buf, self.pos)
+        except json.JSONDecodeError:
+            return None
+        if end < len(self.buf) or self.eof:
+            self.pos = end
+            return value
+        return None
+
+    def error(self, msg: str):
+        raise json.JSONDecodeError(msg, self.buf, self.pos)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT
+
+import io
+import json
+from .json import JSONVar, JSONUEFIVarStore
+from .varstore import UEFIVar, UEFIVarStore
+
+# orjson is optional and only used for parsing lines, which are documents of
+# their own
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JSONLUEFIVarStore(JSONUEFIVarStore):
+    # JSON Lines: one line of JSON per variable, tagged with the id of the
+    # store it belongs to. Lines stand on their own, so streams of many
+    # stores can be appended to, concatenated and split at any line.
+    compact = True
+    store_id = None
+    # Output option: append to the output file instead of replacing it
+    append = False
+
+    def __init__(self, data, store: str = None):
+        UEFIVarStore.__init__(self)
+
+        # Picks the given store, or the only one in the input
+        picked = store is not None
+        for store_id, var in self.read_lines(data):
+            if store is None:
+                store = store_id
+            if store_id == store:
+                self.vars.append(var)
+            elif not picked:
+                raise SystemExit('Input contains more than one store, pick one with --store')
+        self.store_id = store
+
+    @classmethod
+    def find_var(cls, data, name: str, guid: bytes, store: str = None) -> UEFIVar:
+        # Like the constructor, looks in the given store or the only one
+        for var in cls(data, store).vars:
+            if var.name == name and var.guid == guid:
+                return var
+        return None
+
+    @classmethod
+    def iter_stores(cls, data, start: int = 0, end: int = None):
+        # Yields (store id, [UEFIVar]) for every run of lines of the same
+        # store that starts within the byte range [start, end) of data
+        # (bytes or a seekable binary file). Splitting a stream into ranges
+        # can split a store, so readers should merge runs by store id.
+        store, vars = None, []
+        for store_id, var in cls.read_lines(data, start, end):
+            if vars and store_id != store:
+                yield store, vars
+                vars = []
+            store = store_id
+            vars.append(var)
+        if vars:
+            yield store, vars
+
+    @classmethod
+    def read_lines(cls, data, start: int = 0, end: int = None):
+        # Yields (store id, UEFIVar) for every line that starts within the
+        # byte range [start, end) of data
+        if not hasattr(data, 'read'):
+            data = io.BytesIO(data)
+        if start:
+            # The line that starts right at start is ours, the one before
+            # is not
+            data.seek(start - 1)
+            data.readline()
+        loads = orjson.loads if orjson is not None else json.loads
+
+        offset = data.tell() if end is not None else None
+        for line in data:
+            if end is not None:
+                if offset >= end:
+                    break
+                offset += len(line)
+            if not line.strip():
+                continue
+
+            jvar = loads(line)
+            var = JSONVar(jvar, jvar.get('encoding', 'hex'))
+            var.__class__ = UEFIVar
+            yield jvar['store'], var
+
+    def open_output(self, path):
+        if self.append:
+            return open(path, "ab")
+        return super().open_output(path)
+
+    def chunks(self):
+        for var in self.vars:
+            line = {"store": self.store_id}
+            if self.encoding != 'hex':
+                line["encoding"] = self.encoding
+            line.update(self.prepare(var))
+            yield self.dump_var(line) + b'\n'
+
+    def set_output_options(self, options):
+        rest = []
+        for option in [option.strip().split("=") for option in options]:
+            if option[0] == 'store':
+                if (len(option) != 2 or not option[1]):
+                    raise SystemExit(
+                        'option "store" requires a second argument'
+                    )
+                self.store_id = option[1]
+            elif option[0] == 'append':
+                self.append = True
+            else:
+                rest.append('='.join(option))
+        super().set_output_options(rest)
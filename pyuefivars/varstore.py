@@ -28,6 +28,18 @@ class UEFIVar(object):
 
         return var
 
+    @property
+    def data(self) -> bytes:
+        # Backends may hand us a memoryview into their decode buffer. Only
+        # turn it into bytes once somebody actually asks for the contents.
+        if isinstance(self._data, memoryview):
+            self._data = self._data.tobytes()
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
 
 class UEFIVarStore(object):
     EMPTY_TIMESTAMP = b'\0' * 16
@@ -39,10 +51,25 @@ class UEFIVarStore(object):
     def __dict__(self):
         return self.vars
 
+    @classmethod
+    def find_var(cls, data, name: str, guid: bytes) -> UEFIVar:
+        # Return a single variable from a store (or None). Backends that can
+        # do better than parsing everything override this.
+        for var in cls(data).vars:
+            if var.name == name and var.guid == guid:
+                return var
+        return None
+
     def __bytes__(self):
         print("This output backend does not implement writing the variable store", file=sys.stderr)
         sys.exit()
 
+    def open_output(self, path):
+        return open(path, "wb")
+
+    def write(self, outfile):
+        outfile.write(bytes(self))
+
     def set_output_options(self, options):
         print("This output backend does not implement output options: {}".format(options), file=sys.stderr)
         sys.exit()
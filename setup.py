@@ -19,6 +19,10 @@ setuptools.setup(
     url="https://github.com/awslabs/python-uefivars",
     packages=setuptools.find_packages(),
     install_requires=['google-crc32c', 'deepdiff'],
+    extras_require={
+        # Optional speedups: orjson for JSON Lines input, NumPy for FV checksums
+        'fast': ['orjson', 'numpy'],
+    },
     entry_points={
         'console_scripts': [
             'uefivars = pyuefivars:main',
@@ -4,8 +4,19 @@
 # SPDX-License-Identifier: MIT
 
 from deepdiff import DeepDiff
+import base64
 import json
+import os
+import select
 import subprocess
+import pytest
+import uuid
+
+import pyuefivars.codec
+from pyuefivars.aws import AWSUEFIVarStore
+from pyuefivars.edk2 import EDK2UEFIVarStore, EDK2Watch
+from pyuefivars.json import JSONUEFIVarStore
+from pyuefivars.varstore import UEFIVar
 
 
 def run_uefivars(input_type: str = None, input_file: str = None,
@@ -91,3 +102,528 @@ def test_t02_aws_to_edk2_json_aws_json():
     json = run_convert(input_type='aws', input_data=aws, output_type='json')
 
     check_json(json, open('testdata/t02.json', 'rb').read())
+
+
+def test_t02_edk2_pipe():
+    # Input files that can not be mapped get read
+    edk2 = open('testdata/t02.edk2', 'rb').read()
+    json = run_convert(input_type='edk2', input_file='/dev/stdin', input_data=edk2, output_type='json')
+    check_json(json, open('testdata/t02.json', 'rb').read())
+
+# T03: Check AWS output options
+
+
+def test_t03_aws_budget():
+    aws = run_convert(input_type='aws', input_file='testdata/t02.aws', output_type='aws,budget=7000')
+    assert len(aws) <= 7000
+
+    json = run_convert(input_type='aws', input_data=aws, output_type='json')
+    check_json(json, open('testdata/t02.json', 'rb').read())
+
+    result = run_uefivars(input_type='aws', input_file='testdata/t02.aws', output_type='aws,budget=100')
+    assert result.returncode != 0
+
+
+def test_t03_aws_threads(tmp_path):
+    # Large enough to be split into several independently deflated pieces
+    dbx = tmp_path / 'dbx.esl'
+    dbx.write_bytes(b''.join(i.to_bytes(4, 'little') * 12 for i in range(16384)))
+
+    aws = run_convert(input_type='none', output_type='aws,threads=4', extra_args=['-x', str(dbx)])
+    edk2 = run_convert(input_type='aws', input_data=aws, output_type='edk2,filesize=2048')
+    single = run_convert(input_type='none', output_type='edk2,filesize=2048', extra_args=['-x', str(dbx)])
+    assert edk2 == single
+
+
+def test_t03_aws_incremental(tmp_path):
+    dbx = tmp_path / 'dbx.esl'
+    dbx.write_bytes(b'\x01' * 64)
+
+    aws = run_convert(input_type='aws', input_file='testdata/t02.aws', output_type='aws,incremental')
+    json = run_convert(input_type='aws', input_data=aws, output_type='json')
+    check_json(json, open('testdata/t02.json', 'rb').read())
+
+    # Replacing dbx keeps the compressed records in front of it
+    new = run_convert(input_type='aws', input_data=aws, output_type='aws,incremental',
+                      extra_args=['-x', str(dbx)])
+    old, new = base64.b64decode(aws), base64.b64decode(new)
+    assert old[16:800] == new[16:800]
+
+    expected = run_convert(input_type='aws', input_file='testdata/t02.aws', output_type='json',
+                           extra_args=['-x', str(dbx)])
+    check_json(run_convert(input_type='aws', input_data=base64.b64encode(new), output_type='json'), expected)
+
+    for option in ('budget=7000', 'threads=4'):
+        result = run_uefivars(input_type='aws', input_file='testdata/t02.aws', output_type='aws,incremental,' + option)
+        assert result.returncode != 0 and not result.stdout
+
+# T04: Check header-only verification of AWS blobs
+
+
+def test_t04_verify(tmp_path):
+    data = bytearray(base64.b64decode(open('testdata/t02.aws', 'rb').read()))
+    data[100] ^= 0xff
+    corrupt = tmp_path / 'corrupt.aws'
+    corrupt.write_bytes(base64.b64encode(data))
+
+    result = run_uefivars(extra_args=['--verify', 'testdata/t02.aws'])
+    assert result.returncode == 0
+    assert result.stdout == b'testdata/t02.aws: OK\n'
+
+    result = run_uefivars(extra_args=['--verify', 'testdata/t02.aws', str(corrupt)])
+    assert result.returncode == 1
+    assert b'corrupt.aws: FAILED (Invalid checksum' in result.stdout
+
+
+def test_t04_truncated():
+    aws = open('testdata/t02.aws', 'rb').read()
+
+    # Line wrapped input is fine, cut off input is reported as such
+    wrapped = b'\n'.join(aws[i:i + 76] for i in range(0, len(aws), 76))
+    json = run_convert(input_type='aws', input_data=wrapped, output_type='json')
+    check_json(json, open('testdata/t02.json', 'rb').read())
+
+    result = run_uefivars(input_type='aws', input_data=aws[:3000], output_type='json')
+    assert result.returncode != 0
+    assert b'Invalid checksum' in result.stderr
+
+
+def test_t04_iter_vars():
+    aws = open('testdata/t02.aws', 'rb').read()
+    names = [var.name for var in AWSUEFIVarStore(aws).vars]
+    assert [var.name for var in AWSUEFIVarStore.iter_vars(aws)] == names
+    for data in (aws.decode('ascii'), bytearray(aws), memoryview(aws)):
+        assert [var.name for var in AWSUEFIVarStore(data).vars] == names
+
+    # A wrong checksum only shows after the last variable
+    data = bytearray(base64.b64decode(aws))
+    data[8] ^= 0xff
+    seen = []
+    with pytest.raises(Exception, match='Invalid checksum'):
+        for var in AWSUEFIVarStore.iter_vars(base64.b64encode(data)):
+            seen.append(var.name)
+    assert seen == names
+
+
+def test_t04_record_chunks(monkeypatch):
+    # Records that straddle inflate chunks take the field by field path
+    aws = open('testdata/t02.aws', 'rb').read()
+    expected = [var.__dict__() for var in AWSUEFIVarStore(aws).vars]
+    monkeypatch.setattr(AWSUEFIVarStore, 'INFLATE_CHUNK', 61)
+    assert [var.__dict__() for var in AWSUEFIVarStore(aws).vars] == expected
+
+# T05: Check that hostile AWS input can not make us allocate arbitrary amounts of memory
+
+
+def test_t05_aws_limits(tmp_path):
+    dbx = tmp_path / 'dbx.esl'
+    dbx.write_bytes(b'\0' * (5 * 1024 * 1024))
+    aws = run_convert(input_type='none', output_type='aws', extra_args=['-x', str(dbx)])
+    assert len(aws) < 16 * 1024
+
+    result = run_uefivars(input_type='aws', input_data=aws, output_type='json')
+    assert result.returncode != 0
+    assert b'exceeds limit' in result.stderr
+
+# T06: Check single variable lookups
+
+
+def test_t06_get():
+    expected = json.loads(open('testdata/t02.json', 'rb').read())
+    expected['variables'] = [var for var in expected['variables'] if var['name'] == 'dbx']
+    expected = json.dumps(expected).encode('utf-8')
+
+    for input_type in ('aws', 'edk2'):
+        out = run_convert(input_type=input_type, input_file='testdata/t02.' + input_type, output_type='json',
+                          extra_args=['--get', 'dbx:d719b2cb-3d3a-4596-a3bc-dad00e67656f'])
+        check_json(out, expected)
+
+    result = run_uefivars(input_type='aws', input_file='testdata/t02.aws', output_type='json',
+                          extra_args=['--get', 'dbx:8be4df61-93ca-11d2-aa0d-00e098032b8c'])
+    assert result.returncode != 0
+
+# T07: Check that EDK2 files are written sparse but with full contents
+
+
+def test_t07_edk2_sparse(tmp_path):
+    out = tmp_path / 'out.edk2'
+    run_convert(input_type='aws', input_file='testdata/t02.aws', output_type='edk2', output_file=str(out))
+    assert out.read_bytes() == open('testdata/t02.edk2', 'rb').read()
+
+# T08: Check in place updates of EDK2 files
+
+
+def test_t08_edk2_edit(tmp_path):
+    dbx = tmp_path / 'dbx.esl'
+    dbx.write_bytes(b'\x01' * 64)
+    edk2 = tmp_path / 'vars.edk2'
+    edk2.write_bytes(open('testdata/t02.edk2', 'rb').read())
+
+    run_convert(extra_args=['--edit', str(edk2), '-x', str(dbx)])
+    assert edk2.stat().st_size == len(open('testdata/t02.edk2', 'rb').read())
+
+    out = run_convert(input_type='edk2', input_file=str(edk2), output_type='json')
+    expected = run_convert(input_type='edk2', input_file='testdata/t02.edk2', output_type='json',
+                           extra_args=['-x', str(dbx)])
+    check_json(out, expected)
+
+
+def test_t08_edk2_reclaim(tmp_path):
+    dbx = tmp_path / 'dbx.esl'
+    dbx.write_bytes(b'\x01' * 64)
+    edk2 = tmp_path / 'vars.edk2'
+    edk2.write_bytes(open('testdata/t02.edk2', 'rb').read())
+    run_convert(extra_args=['--edit', str(edk2), '-x', str(dbx)])
+    expected = run_convert(input_type='edk2', input_file=str(edk2), output_type='json')
+
+    stats = run_convert(extra_args=['--stats', str(edk2)])
+    assert b'dead: 0 bytes' not in stats
+
+    edk2.chmod(0o600)
+    inode = edk2.stat().st_ino
+    stats = run_convert(extra_args=['--reclaim', str(edk2)])
+    assert b'dead: 0 bytes' in stats
+    assert run_convert(input_type='edk2', input_file=str(edk2), output_type='json') == expected
+
+    # The compacted file replaced the old one as a whole
+    assert edk2.stat().st_ino != inode and edk2.stat().st_mode & 0o777 == 0o600
+    assert sorted(os.listdir(tmp_path)) == ['dbx.esl', 'vars.edk2']
+
+
+def record_offset(path, name: str) -> int:
+    # Offset of the last record of variable name
+    return max(record.offset for record in EDK2UEFIVarStore.scan(str(path)) if record.name == name)
+
+
+def test_t08_edk2_in_deleted_transition(tmp_path):
+    # A record caught in deleted transition without a settled copy is still live
+    edk2 = tmp_path / 'vars.edk2'
+    data = bytearray(open('testdata/t02.edk2', 'rb').read())
+    data[record_offset('testdata/t02.edk2', 'dbx') + 2] = EDK2UEFIVarStore.STATE_IN_DELETED_TRANSITION
+    edk2.write_bytes(data)
+    expected = run_convert(input_type='edk2', input_file='testdata/t02.edk2', output_type='json')
+    assert run_convert(input_type='edk2', input_file=str(edk2), output_type='json') == expected
+    assert b'dead: 0 bytes' in run_convert(extra_args=['--stats', str(edk2)])
+
+    run_convert(extra_args=['--reclaim', str(edk2)])
+    assert edk2.read_bytes() == open('testdata/t02.edk2', 'rb').read()
+
+
+def test_t08_edk2_interrupted_edit(tmp_path):
+    dbx = tmp_path / 'dbx.esl'
+    dbx.write_bytes(b'\x01' * 64)
+    edk2 = tmp_path / 'vars.edk2'
+    edk2.write_bytes(open('testdata/t02.edk2', 'rb').read())
+    run_convert(extra_args=['--edit', str(edk2), '-x', str(dbx)])
+    edited = edk2.read_bytes()
+    old = record_offset('testdata/t02.edk2', 'dbx')
+    new = record_offset(edk2, 'dbx')
+    original = run_convert(input_type='edk2', input_file='testdata/t02.edk2', output_type='json')
+    expected = run_convert(input_type='edk2', input_file=str(edk2), output_type='json')
+
+    # Crash before the new record got written, while it was only header
+    # valid, and before the old one got deleted
+    for new_state in [None, EDK2UEFIVarStore.STATE_HEADER_VALID_ONLY, EDK2UEFIVarStore.STATE_SETTLED]:
+        data = bytearray(edited)
+        data[old + 2] = EDK2UEFIVarStore.STATE_IN_DELETED_TRANSITION
+        if new_state is None:
+            data[new:] = b'\xff' * (len(data) - new)
+        else:
+            data[new + 2] = new_state
+        edk2.write_bytes(data)
+
+        out = run_convert(input_type='edk2', input_file=str(edk2), output_type='json')
+        check_json(out, expected if new_state == EDK2UEFIVarStore.STATE_SETTLED else original)
+
+        # Redoing the edit from there completes it
+        run_convert(extra_args=['--edit', str(edk2), '-x', str(dbx)])
+        check_json(run_convert(input_type='edk2', input_file=str(edk2), output_type='json'), expected)
+
+# T09: Check listing variables without reading them
+
+
+def test_t09_list():
+    out = run_convert(extra_args=['--list', 'testdata/t02.edk2'])
+    lines = out.decode('utf-8').splitlines()
+    variables = json.loads(open('testdata/t02.json', 'rb').read())['variables']
+    assert len(lines) == len(variables) + 1  # certdb
+    assert 'testdata/t02.edk2: dbx:d719b2cb-3d3a-4596-a3bc-dad00e67656f attr=0x27 size=' in out.decode('utf-8')
+
+# T10: Check automatic EDK2 file sizes
+
+
+def test_t10_edk2_filesize_auto(tmp_path):
+    edk2 = run_convert(input_type='aws', input_file='testdata/t02.aws', output_type='edk2,filesize=auto')
+    assert len(edk2) == 0x20000
+    json = run_convert(input_type='edk2', input_data=edk2, output_type='json')
+    check_json(json, open('testdata/t02.json', 'rb').read())
+
+    dbx = tmp_path / 'dbx.esl'
+    dbx.write_bytes(b'\x01' * 0x10000)
+    edk2 = run_convert(input_type='aws', input_file='testdata/t02.aws', output_type='edk2,filesize=auto',
+                       extra_args=['-x', str(dbx)])
+    assert len(edk2) == 0x84000
+
+    dbx.write_bytes(b'\x01' * 0x40000)
+    result = run_uefivars(input_type='aws', input_file='testdata/t02.aws', output_type='edk2,filesize=auto',
+                          extra_args=['-x', str(dbx)])
+    assert result.returncode != 0 and not result.stdout
+    assert b'Can not fit' in result.stderr
+
+# T11: Check variable stores embedded in complete firmware images
+
+
+def test_t11_edk2_embedded(tmp_path):
+    edk2 = open('testdata/t02.edk2', 'rb').read()
+    code = bytes(range(256)) * 1024
+    image = tmp_path / 'OVMF.fd'
+    image.write_bytes(code + edk2 + code)
+
+    json = run_convert(input_type='edk2', input_file=str(image), output_type='json')
+    check_json(json, open('testdata/t02.json', 'rb').read())
+
+    dbx = tmp_path / 'dbx.esl'
+    dbx.write_bytes(b'\x01' * 64)
+    run_convert(input_type='edk2', input_file=str(image), output_type='edk2,inplace', output_file=str(image),
+                extra_args=['-x', str(dbx)])
+    data = image.read_bytes()
+    assert data[:len(code)] == code and data[-len(code):] == code
+    expected = run_convert(input_type='edk2', input_file='testdata/t02.edk2', output_type='edk2',
+                           extra_args=['-x', str(dbx)])
+    assert data[len(code):-len(code)] == expected
+
+# T12: Check that only changed blocks get written to existing EDK2 files
+
+
+def test_t12_edk2_blockdiff(tmp_path):
+    out = tmp_path / 'out.edk2'
+    result = run_uefivars(input_type='aws', input_file='testdata/t02.aws', output_type='edk2,blockdiff',
+                          output_file=str(out))
+    assert result.returncode == 0
+    assert b'Wrote 4 of 132 blocks: 0 1 2 3\n' in result.stderr
+    assert out.read_bytes() == open('testdata/t02.edk2', 'rb').read()
+
+    result = run_uefivars(input_type='aws', input_file='testdata/t02.aws', output_type='edk2,blockdiff',
+                          output_file=str(out))
+    assert b'Wrote 0 of 132 blocks\n' in result.stderr
+    assert out.read_bytes() == open('testdata/t02.edk2', 'rb').read()
+
+# T13: Check change events from watching EDK2 files
+
+
+def test_t13_edk2_watch(tmp_path):
+    dbx = tmp_path / 'dbx.esl'
+    dbx.write_bytes(b'\x01' * 64)
+    edk2 = tmp_path / 'vars.edk2'
+    edk2.write_bytes(open('testdata/t02.edk2', 'rb').read())
+
+    watch = subprocess.Popen(['./uefivars', '--watch', str(edk2), '--interval', '0.05'],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        assert watch.stderr.readline().startswith(b'Watching')
+        run_convert(extra_args=['--edit', str(edk2), '-x', str(dbx)])
+        assert select.select([watch.stdout], [], [], 10)[0]
+        event = json.loads(watch.stdout.readline())
+    finally:
+        watch.kill()
+        watch.wait()
+
+    assert event == {
+        "event": "modified",
+        "name": "dbx",
+        "guid": "d719b2cb-3d3a-4596-a3bc-dad00e67656f",
+        "attr": 0x27,
+        "data": "01" * 64,
+    }
+
+
+def test_t13_edk2_watch_retry(tmp_path):
+    # A poll that catches a write half way fails, and the next one still
+    # reports everything that changed since the last good one
+    edk2 = tmp_path / 'vars.edk2'
+    data = bytearray(open('testdata/t02.edk2', 'rb').read())
+    edk2.write_bytes(data)
+    watch = EDK2Watch(str(edk2))
+    tail = max(record.offset + record.size for record in EDK2UEFIVarStore.scan(str(edk2)))
+
+    data[record_offset(edk2, 'dbx') + 2] = EDK2UEFIVarStore.STATE_DELETED
+    data[tail:tail + 2] = b'\xaa\x55'
+    data[tail + 40:tail + 44] = (0x7fffffff).to_bytes(4, 'little')
+    edk2.write_bytes(data)
+    os.utime(edk2, ns=(1, 1))
+    with pytest.raises(Exception, match='Unexpected end of buffer'):
+        watch.poll()
+
+    data[tail:tail + 60] = b'\xff' * 60
+    edk2.write_bytes(data)
+    os.utime(edk2, ns=(2, 2))
+    assert [event[:2] for event in watch.poll()] == [('deleted', 'dbx')]
+
+# T14: Check the incremental JSON reader with differently laid out documents
+
+
+def test_t14_json_layout():
+    check = open('testdata/t02.json', 'rb').read()
+    jdata = json.loads(check)
+
+    compact = json.dumps({"variables": jdata['variables'], "version": 2}, separators=(',', ':'))
+    out = run_convert(input_type='json', input_data=compact.encode('utf-8'), output_type='json')
+    assert out == run_convert(input_type='json', input_file='testdata/t02.json', output_type='json')
+    check_json(out, check)
+
+    v1 = json.dumps(jdata['variables'])
+    check_json(run_convert(input_type='json', input_data=v1.encode('utf-8'), output_type='json'), check)
+
+    result = run_uefivars(input_type='json', input_data=compact[:-2].encode('utf-8'), output_type='json')
+    assert result.returncode != 0
+
+
+def test_t14_json_chunks(monkeypatch):
+    # Documents larger than a chunk get parsed one variable at a time
+    check = open('testdata/t02.json', 'rb').read()
+    expected = [var.__dict__() for var in JSONUEFIVarStore(check).vars]
+    for size in (1, 7, 4096):
+        monkeypatch.setattr(JSONUEFIVarStore, 'CHUNK_SIZE', size)
+        assert [var.__dict__() for var in JSONUEFIVarStore(check).vars] == expected
+        v1 = json.dumps(json.loads(check)['variables']).encode('utf-8')
+        assert [var.__dict__() for var in JSONUEFIVarStore(v1).vars] == expected
+
+
+def test_t14_json_iter_vars():
+    names = [var['name'] for var in json.load(open('testdata/t02.json', 'rb'))['variables']]
+    with open('testdata/t02.json', 'rb') as f:
+        assert [var.name for var in JSONUEFIVarStore.iter_vars(f)] == names
+
+    # A document cut off after the last variable fails only after yielding it
+    compact = run_convert(input_type='json', input_file='testdata/t02.json', output_type='json,compact')
+    seen = []
+    with pytest.raises(json.JSONDecodeError):
+        for var in JSONUEFIVarStore.iter_vars(compact.rstrip()[:-2]):
+            seen.append(var.name)
+    assert seen == names
+
+# T15: Check base64 encoded and compact JSON output
+
+
+def test_t15_json_base64_compact():
+    check = open('testdata/t02.json', 'rb').read()
+    for options in (',base64', ',compact', ',base64,compact'):
+        out = run_convert(input_type='aws', input_file='testdata/t02.aws', output_type='json' + options)
+        assert len(out) < len(check)
+        jdata = json.loads(out)
+        assert jdata['version'] == (3 if 'base64' in options else 2)
+
+        json_out = run_convert(input_type='json', input_data=out, output_type='json')
+        check_json(json_out, check)
+
+
+def test_t15_json_dumps():
+    # The streaming writer has to match json.dumps() of the whole document
+    # byte for byte, also for names that need escaping
+    varstore = JSONUEFIVarStore(open('testdata/t02.json', 'rb'))
+    guid = varstore.vars[0].guid
+    varstore.vars += [UEFIVar(''.join(map(chr, range(0x20))) + '"\\\x7f', b'\x00', guid, 7),
+                      UEFIVar('Caf\u00e9\u2028\U0001f600', b'\xff', guid, 7, b'\x01' * 16, b'\x02' * 32)]
+    for variables in (varstore.vars, []):
+        varstore.vars = variables
+        for encoding in ('hex', 'base64'):
+            for compact in (False, True):
+                varstore.encoding, varstore.compact = encoding, compact
+                document = {"version": 2 if encoding == 'hex' else 3}
+                if encoding != 'hex':
+                    document["encoding"] = encoding
+                document["variables"] = [varstore.prepare(var) for var in variables]
+                if compact:
+                    expected = json.dumps(document, separators=(',', ':'))
+                else:
+                    expected = json.dumps(document, indent=4)
+                assert bytes(varstore) == expected.encode('utf-8')
+
+# T16: Check JSON Lines streams of several stores
+
+
+def test_t16_jsonl(tmp_path):
+    check = open('testdata/t02.json', 'rb').read()
+    fleet = tmp_path / 'fleet'
+    fleet.mkdir()
+    for name in ('vm1.aws', 'vm2.aws'):
+        (fleet / name).write_bytes(open('testdata/t02.aws', 'rb').read())
+
+    stream = tmp_path / 'fleet.jsonl'
+    run_convert(input_type='aws', input_file=str(fleet), output_type='jsonl', output_file=str(stream))
+    run_convert(input_type='json', input_file='testdata/t02.json', output_type='jsonl,append,base64,store=vm3',
+                output_file=str(stream))
+    lines = stream.read_bytes().splitlines()
+    assert len(lines) == 3 * len(json.loads(check)['variables'])
+    assert json.loads(lines[0])['store'] == 'vm1.aws'
+
+    for store in ('vm1.aws', 'vm2.aws', 'vm3'):
+        out = run_convert(input_type='jsonl', input_file=str(stream), output_type='json', extra_args=['--store', store])
+        check_json(out, check)
+
+    result = run_uefivars(input_type='jsonl', input_file=str(stream), output_type='json')
+    assert result.returncode != 0
+
+    dbx = run_convert(input_type='jsonl', input_file=str(stream), output_type='json',
+                      extra_args=['--store', 'vm2.aws', '--get', 'dbx:d719b2cb-3d3a-4596-a3bc-dad00e67656f'])
+    assert [var['name'] for var in json.loads(dbx)['variables']] == ['dbx']
+
+    # Unreadable files get reported and skipped, and store ids come from the
+    # file names only
+    (fleet / 'vm0.aws').write_bytes(b'garbage')
+    result = run_uefivars(input_type='aws', input_file=str(fleet), output_type='jsonl', output_file=str(stream))
+    assert result.returncode != 0
+    assert b'vm0.aws' in result.stderr
+    assert {json.loads(line)['store'] for line in stream.read_bytes().splitlines()} == {'vm1.aws', 'vm2.aws'}
+
+    result = run_uefivars(input_type='aws', input_file=str(fleet), output_type='jsonl,store=vm3')
+    assert result.returncode != 0 and not result.stdout
+
+    # The same goes for input the parser rejects with an error message
+    docs = tmp_path / 'docs'
+    docs.mkdir()
+    for name in ('a.json', 'c.json'):
+        (docs / name).write_bytes(check)
+    (docs / 'b.json').write_bytes(b'{"version": 99, "variables": []}')
+    result = run_uefivars(input_type='json', input_file=str(docs), output_type='jsonl')
+    assert result.returncode != 0
+    assert b'b.json: Unknown Version' in result.stderr
+    assert {json.loads(line)['store'] for line in result.stdout.splitlines()} == {'a.json', 'c.json'}
+
+# T17: Check that efivarfs variables come out in a stable order
+
+
+def test_t17_efivarfs_order():
+    out = run_convert(input_type='efivarfs', input_file='testdata/t01.efivarfs', output_type='json')
+    variables = json.loads(out)['variables']
+    keys = [(var['name'], uuid.UUID(var['guid']).bytes_le) for var in variables]
+    assert keys == sorted(keys)
+    check_json(out, open('testdata/t01.json', 'rb').read())
+
+# T18: Check EDK2 stores with records past varsize, which older versions wrote
+
+
+def test_t18_edk2_overflow(tmp_path):
+    edk2 = tmp_path / 'vars.edk2'
+    data = bytearray(open('testdata/t02.edk2', 'rb').read())
+    data[0x48 + 16:0x48 + 20] = (0x1000).to_bytes(4, 'little')
+    edk2.write_bytes(data)
+    result = run_uefivars(input_type='edk2', input_file=str(edk2), output_type='json')
+    assert result.returncode == 0
+    assert b'Variable store overflows varsize 0x1000' in result.stderr
+    check_json(result.stdout, open('testdata/t02.json', 'rb').read())
+
+# T19: Check that block checksums come out the same with and without NumPy
+
+
+def test_t19_csum16_blocks(monkeypatch):
+    if not pyuefivars.codec.load_numpy():
+        pytest.skip('NumPy is not installed')
+    image = open('testdata/t02.edk2', 'rb').read()
+    blockmap = EDK2UEFIVarStore(image).blockmap
+    assert blockmap == [(132, 0x1000)]
+
+    csums = pyuefivars.codec.csum16_blocks(image, blockmap)
+    monkeypatch.setattr(pyuefivars.codec, 'numpy', False)
+    assert pyuefivars.codec.csum16_blocks(image, blockmap) == csums
+    assert csums[1] == sum(int.from_bytes(image[i:i + 2], 'little') for i in range(0x1000, 0x2000, 2)) & 0xffff